@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+""" Poll, discovery and command benchmarks for the Hue Node Server
+
+Runs the Control node server against simulated bridges (see hue_sim.py) in the
+same process. polyinterface is replaced with a minimal in-memory stand-in that
+counts setDriver calls and the driver updates that would be reported to the ISY.
+Node server defaults apply, e.g. `poll_jitter` spreads polls of several bridges and
+`light_rate` caps command throughput; override them with --param.
+
+    ./bench.py --lights 10,100,1000 --bridges 1,2,3,4,5 --output bench.json
+    ./bench.py --lights 100 --bridges 2 --param full_poll --param async_commands
+    ./bench.py --converters
+    ./bench.py --buttons 0.1,0.25,0.5 --lights 50
+"""
+
+import argparse
+import json
+import logging
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+import types
+
+import hue_sim
+
+LOGGER = logging.getLogger('bench')
+
+
+class StubNode(object):
+    """ Enough of polyinterface.Node to run the node classes without Polyglot """
+
+    def __init__(self, controller, primary, address, name):
+        self.controller = controller
+        self.primary = primary
+        self.address = address
+        self.name = name
+        self.drivers = [dict(driver) for driver in self.drivers]
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None):
+        COUNTERS['set_driver'] += 1
+        for entry in self.drivers:
+            if entry['driver'] == driver:
+                if report and (force or entry['value'] != value):
+                    COUNTERS['reported'] += 1
+                entry['value'] = value
+                if uom is not None:
+                    entry['uom'] = uom
+                break
+
+    def getDriver(self, driver):
+        for entry in self.drivers:
+            if entry['driver'] == driver:
+                return entry['value']
+        return None
+
+    def reportDrivers(self):
+        COUNTERS['reported'] += len(self.drivers)
+
+    def reportCmd(self, command, value=None, uom=None):
+        COUNTERS['report_cmd'] += 1
+        REPORTED_COMMANDS.append((time.time(), self.address, command))
+
+    def start(self):
+        pass
+
+    def query(self, command=None):
+        pass
+
+    drivers = []
+
+
+class StubController(StubNode):
+    """ Enough of polyinterface.Controller to run Control without Polyglot """
+
+    def __init__(self, poly):
+        self.poly = poly
+        self.controller = self
+        self.nodes = {}
+        self.polyConfig = {'customParams': {}, 'customData': {}}
+        self.drivers = [dict(driver) for driver in self.drivers]
+
+    def addNode(self, node, update=False):
+        new = node.address not in self.nodes
+        self.nodes[node.address] = node
+        if new:
+            node.start()
+        return node
+
+    def delNode(self, address):
+        self.nodes.pop(address, None)
+
+    def addNotice(self, data, key=None):
+        pass
+
+    def removeNoticesAll(self):
+        pass
+
+    def saveCustomData(self, data):
+        self.polyConfig['customData'] = data
+
+
+COUNTERS = {'set_driver': 0, 'reported': 0, 'report_cmd': 0}
+""" (time, address, command) of every reportCmd call since the counters were reset """
+REPORTED_COMMANDS = []
+
+
+def stub_polyinterface():
+    """ Install the in-memory polyinterface, must run before hue or node_types are imported """
+    module = types.ModuleType('polyinterface')
+    module.LOGGER = logging.getLogger('polyinterface')
+    module.LOGGER.addHandler(logging.NullHandler())
+    module.LOGGER.propagate = False
+    module.Node = StubNode
+    module.Controller = StubController
+    module.Interface = object
+    sys.modules['polyinterface'] = module
+    return module
+
+
+def reset_counters():
+    for key in COUNTERS:
+        COUNTERS[key] = 0
+    del REPORTED_COMMANDS[:]
+
+
+def percentile(values, pct):
+    """ Nearest rank percentile, values need not be sorted """
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100. * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def timing_stats(values):
+    if len(values) == 0:
+        return {}
+    return {'count': len(values), 'mean': sum(values) / len(values), 'min': min(values),
+            'p50': percentile(values, 50), 'p99': percentile(values, 99), 'max': max(values)}
+
+
+def simulator_options(lights, args, serial):
+    """ Mix of light types similar to a typical install, groups of about ten lights """
+    return {'ecolor': lights - lights * 3 // 10 - lights // 10 - lights // 10,
+            'white': lights * 3 // 10, 'dimmable': lights // 10, 'color': lights // 10,
+            'groups': max(1, lights // 10), 'scenes': args.scenes, 'latency': args.latency,
+            'jitter': args.jitter, 'seed': args.seed + serial, 'serial': serial}
+
+
+def wait_for(condition, timeout=600):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise RuntimeError('Timed out waiting for the node server')
+        time.sleep(0.005)
+
+
+def discovery_idle():
+    return not any(thread.name.startswith('HueDiscover-') for thread in threading.enumerate())
+
+
+def commands_idle(control):
+    if any(dispatcher.queue.qsize() > 0 for dispatcher in control.dispatchers.values()):
+        return False
+    if control.batcher is not None and len(control.batcher.pending) > 0:
+        return False
+    return all(getattr(node, 'pending_command', None) is None for node in list(control.nodes.values()))
+
+
+def churn(bridges, fraction, rnd):
+    """ Change brightness of a fraction of the simulated lights, as if someone used an app """
+    changed = 0
+    for bridge in bridges:
+        with bridge.lock:
+            for light in bridge.lights.values():
+                if rnd.random() < fraction:
+                    light['state']['bri'] = rnd.randint(1, 254)
+                    changed += 1
+    return changed
+
+
+def run_scenario(hue, lights, bridge_count, args):
+    servers = []
+    bridges = []
+    for serial in range(bridge_count):
+        server, bridge = hue_sim.start_simulator(**simulator_options(lights, args, serial))
+        servers.append(server)
+        bridges.append(bridge)
+    addresses = ['{}:{}'.format(*server.server_address) for server in servers]
+    result = {'lights': lights, 'bridges': bridge_count, 'params': args.param}
+    control = None
+    try:
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        control = hue.Control(None)
+        control.polyConfig['customParams'] = dict(args.param)
+        control.polyConfig['customParams']['bridges'] = json.dumps(addresses)
+        control.polyConfig['customData'] = {'bridges': {str(idx): {'ip': address, 'user': hue_sim.SIM_USER}
+                                                        for idx, address in enumerate(addresses)}}
+
+        ''' Startup: connect to the bridges and add every node '''
+        reset_counters()
+        start = time.time()
+        control.start()
+        wait_for(discovery_idle)
+        result['discovery'] = {'seconds': time.time() - start, 'nodes': len(control.nodes),
+                               'set_driver': COUNTERS['set_driver'], 'reported': COUNTERS['reported']}
+        memory = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+        result['memory'] = {'bytes': memory, 'bytes_per_node': memory // max(1, len(control.nodes))}
+
+        ''' Rediscovery with nothing changed on the bridges '''
+        reset_counters()
+        start = time.time()
+        control.discover()
+        wait_for(discovery_idle)
+        result['rediscovery'] = {'seconds': time.time() - start, 'set_driver': COUNTERS['set_driver'],
+                                 'reported': COUNTERS['reported']}
+
+        ''' Poll cycles, with a fraction of lights changed before each one '''
+        rnd = hue_sim.random.Random(args.seed)
+        durations = []
+        reset_counters()
+        changed = 0
+        for _ in range(args.polls):
+            changed += churn(bridges, args.churn, rnd)
+            start = time.time()
+            if control.adaptive_poll:
+                with control.poll_lock:
+                    control._pollHubs({idx: ['lights', 'groups'] for idx, hub in control.hub.items() if hub is not None})
+            else:
+                control.shortPoll()
+            durations.append(time.time() - start)
+        result['poll'] = timing_stats(durations)
+        result['poll'].update({'lights_changed': changed,
+                               'set_driver_per_cycle': COUNTERS['set_driver'] / max(1, args.polls),
+                               'reported_per_cycle': COUNTERS['reported'] / max(1, args.polls)})
+
+        ''' Commands cycled over the light nodes, latency is the time the command handler takes '''
+        nodes = [node for node in control.nodes.values() if isinstance(node, hue.HueDimmLight)]
+        sequence = [{'cmd': 'DON', 'value': '128'}, {'cmd': 'BRT'}, {'cmd': 'SET_BRI', 'value': '60'}, {'cmd': 'DOF'}]
+        latencies = []
+        count = min(args.commands, len(nodes) * len(sequence)) if len(nodes) > 0 else 0
+        reset_counters()
+        start = time.time()
+        for idx in range(count):
+            node = nodes[idx % len(nodes)]
+            command = dict(sequence[(idx // len(nodes)) % len(sequence)])
+            sent = time.time()
+            node.commands[command['cmd']](node, command)
+            latencies.append(time.time() - sent)
+        wait_for(lambda: commands_idle(control))
+        elapsed = time.time() - start
+        result['commands'] = timing_stats(latencies)
+        result['commands'].update({'seconds': elapsed, 'per_second': count / elapsed if elapsed > 0 else None,
+                                   'set_driver': COUNTERS['set_driver'], 'reported': COUNTERS['reported']})
+        result['simulator'] = [dict(bridge.stats) for bridge in bridges]
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        if control is not None:
+            control.stop()
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+    return result
+
+
+def converter_benchmark(iterations, seed):
+    """ Table lookups and batch conversion in converters.py against the per-call calculations they replace """
+    import converters
+    import timeit
+    rnd = hue_sim.random.Random(seed)
+    rgb = [(rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)) for _ in range(1000)]
+    for value in range(256):
+        rgb.extend([(value, 0, 0), (0, value, 0), (0, 0, value), (value, value, value)])
+    cases = {
+        'RGB_2_xy': (lambda: [converters.RGB_2_xy(*color) for color in rgb],
+                     lambda: [converters._RGB_2_xy(*color) for color in rgb], len(rgb)),
+        'color_xy': (lambda: [converters.color_xy(c_id) for c_id in converters.colors],
+                     lambda: [converters._RGB_2_xy(*color[1]) for color in converters.colors.values()], len(converters.colors)),
+        'bri2st': (lambda: [converters.bri2st(bri) for bri in range(255)],
+                   lambda: [converters._bri2st(bri) for bri in range(255)], 255),
+        'kel2mired': (lambda: [converters.kel2mired(value) for value in range(6501)],
+                      lambda: [converters._kel2mired(value) for value in range(6501)], 6501),
+        'rgb_to_xy': (lambda: converters.rgb_to_xy(rgb, converters.GAMUTS['C']),
+                      lambda: [converters.clamp_xy(converters.RGB_2_xy(*color), converters.GAMUTS['C']) for color in rgb], len(rgb))
+    }
+    results = {}
+    for name, (table, direct, calls) in cases.items():
+        if table() != direct():
+            raise RuntimeError('{} results differ from the direct calculation'.format(name))
+        table_time = min(timeit.repeat(table, number=iterations, repeat=3)) / (iterations * calls)
+        direct_time = min(timeit.repeat(direct, number=iterations, repeat=3)) / (iterations * calls)
+        results[name] = {'table_ns': table_time * 1e9, 'direct_ns': direct_time * 1e9, 'speedup': direct_time / table_time}
+        LOGGER.info('{:>10}: {:.0f} ns per call, was {:.0f} ns, {:.1f}x'.format(
+            name, table_time * 1e9, direct_time * 1e9, direct_time / table_time))
+    return results
+
+
+def thread_cpu(thread):
+    """ CPU seconds used so far by a running thread """
+    return time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+
+
+def button_benchmark(hue, interval, lights, args):
+    """ Press-to-command latency, poller CPU and bridge requests of the button fast path at one poll interval """
+    options = simulator_options(lights, args, 0)
+    options.update({'dimmers': 4, 'taps': 2, 'motion': 4})
+    server, bridge = hue_sim.start_simulator(**options)
+    address = '{}:{}'.format(*server.server_address)
+    control = None
+    try:
+        control = hue.Control(None)
+        control.polyConfig['customParams'] = dict(args.param)
+        control.polyConfig['customParams']['bridges'] = json.dumps([address])
+        control.polyConfig['customParams']['button_poll'] = str(interval)
+        control.polyConfig['customData'] = {'bridges': {'0': {'ip': address, 'user': hue_sim.SIM_USER}}}
+        control.start()
+        wait_for(discovery_idle)
+        poller = control.button_pollers[address]
+        switches = sorted(control.switchNodes(address).items())
+        wait_for(lambda: poller.polls > 0)
+
+        ''' Idle load: the poller alone, nothing pressed '''
+        window = max(2., interval * 10)
+        cpu, gets, polls = thread_cpu(poller.thread), bridge.stats['GET'], poller.polls
+        time.sleep(window)
+        result = {'interval': interval, 'switches': len(switches), 'sensors': len(bridge.sensors),
+                  'sensors_bytes': len(json.dumps(bridge.sensors)),
+                  'cpu_percent': (thread_cpu(poller.thread) - cpu) / window * 100,
+                  'requests_per_second': (bridge.stats['GET'] - gets) / window,
+                  'polls_per_second': (poller.polls - polls) / window}
+
+        ''' Presses alternate between buttons, the bridge stamps events with whole seconds only '''
+        events = {'ZLLSwitch': [1000, 2000, 3000, 4000], 'ZGPSwitch': [34, 16, 17, 18]}
+        rnd = hue_sim.random.Random(args.seed)
+        latencies = []
+        missed = 0
+        reset_counters()
+        for idx in range(args.presses):
+            sensor_id, node = switches[idx % len(switches)]
+            buttonevent = events[node.data['type']][(idx // len(switches)) % 4]
+            pressed = time.time()
+            bridge.press(sensor_id, buttonevent)
+            try:
+                wait_for(lambda: any(address == node.address for stamp, address, command in REPORTED_COMMANDS), interval * 4 + 2)
+                latencies.append(next(stamp for stamp, address, command in REPORTED_COMMANDS if address == node.address) - pressed)
+            except RuntimeError:
+                missed += 1
+            reset_counters()
+            time.sleep(rnd.uniform(0, interval))
+        result['latency'] = timing_stats(latencies)
+        result['missed'] = missed
+    finally:
+        if control is not None:
+            control.stop()
+        server.shutdown()
+        server.server_close()
+    return result
+
+
+def summary(result):
+    return ('{lights:>5} lights x {bridges} bridges: discovery {discovery:.3f}s, poll p50 {p50:.4f}s p99 {p99:.4f}s, '
+            '{set_driver:.0f} setDriver/poll, commands p50 {cmd_p50:.4f}s {rate:.1f}/s, {memory} bytes/node').format(
+        lights=result['lights'], bridges=result['bridges'], discovery=result['discovery']['seconds'],
+        p50=result['poll'].get('p50') or 0, p99=result['poll'].get('p99') or 0,
+        set_driver=result['poll'].get('set_driver_per_cycle', 0), cmd_p50=result['commands'].get('p50') or 0,
+        rate=result['commands'].get('per_second') or 0, memory=result['memory']['bytes_per_node'])
+
+
+def parse_param(value):
+    """ name or name=value, as entered in Polyglot custom parameters """
+    name, _, val = value.partition('=')
+    return name, val
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hue Node Server benchmarks against simulated bridges')
+    parser.add_argument('--lights', default='10,100,1000', help='comma separated lights per bridge')
+    parser.add_argument('--bridges', default='1,2,3,4,5', help='comma separated bridge counts')
+    parser.add_argument('--scenes', type=int, default=3, help='scenes per group')
+    parser.add_argument('--polls', type=int, default=20, help='poll cycles per scenario')
+    parser.add_argument('--churn', type=float, default=0.1, help='fraction of lights changed before each poll')
+    parser.add_argument('--commands', type=int, default=50, help='commands per scenario')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated bridge latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='simulated bridge latency jitter in seconds')
+    parser.add_argument('--param', action='append', type=parse_param, default=[],
+                        help='node server custom parameter, name or name=value, may be repeated')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--converters', action='store_true', help='run the converters micro-benchmark only')
+    parser.add_argument('--buttons', help='comma separated button poll intervals in seconds, runs the button fast path benchmark only')
+    parser.add_argument('--presses', type=int, default=30, help='button presses per button poll interval')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    stub_polyinterface()
+    import hue
+
+    results = []
+    if args.converters:
+        results.append({'converters': converter_benchmark(max(1, args.commands // 10), args.seed)})
+    elif args.buttons:
+        lights = int(args.lights.split(',')[0])
+        for interval in [float(val) for val in args.buttons.split(',')]:
+            result = button_benchmark(hue, interval, lights, args)
+            LOGGER.info(('button poll {interval}s, {sensors} sensors: press to command p50 {p50:.3f}s p99 {p99:.3f}s, '
+                         'missed {missed}, poller CPU {cpu_percent:.2f}%, {requests_per_second:.1f} requests/s').format(
+                p50=result['latency'].get('p50') or 0, p99=result['latency'].get('p99') or 0, **result))
+            results.append(result)
+    else:
+        for lights in [int(val) for val in args.lights.split(',')]:
+            for bridge_count in [int(val) for val in args.bridges.split(',')]:
+                result = run_scenario(hue, lights, bridge_count, args)
+                LOGGER.info(summary(result))
+                results.append(result)
+
+    report = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+              'platform': platform.platform(), 'args': {key: val for key, val in vars(args).items() if key != 'output'},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        LOGGER.info('Results written to {}'.format(args.output))
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
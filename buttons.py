@@ -0,0 +1,150 @@
+""" Fast polling of Hue switch button events used by the Hue Node Server. """
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+import polyinterface
+import phue
+import socket
+import threading
+import time
+
+LOGGER = polyinterface.LOGGER
+
+""" Sensor types of Hue Dimmer, Smart Button and Tap switches """
+SWITCH_TYPES = ['ZLLSwitch', 'ZGPSwitch']
+""" Dimmer and Smart Button buttons (buttonevent // 1000) and the command each one sends """
+ZLL_BUTTONS = {1: 'DON', 2: 'BRT', 3: 'DIM', 4: 'DOF'}
+""" Hue Tap buttonevent values and the command each one sends """
+TAP_BUTTONS = {34: 'DON', 16: 'BRT', 17: 'DIM', 18: 'DOF'}
+""" Dimmer and Smart Button events (buttonevent % 1000) """
+INITIAL_PRESS = 0
+HOLD = 1
+SHORT_RELEASE = 2
+LONG_RELEASE = 3
+""" Seconds a request to the bridge may take """
+BUTTON_TIMEOUT = 5
+""" Longest wait between reconnection attempts """
+MAX_RECONNECT_DELAY = 60
+""" Seconds between checks for switch nodes on a hub that has none """
+IDLE_INTERVAL = 5
+""" Shortest interval between button polls, faster polls only load the bridge """
+MIN_BUTTON_POLL = 0.1
+
+
+def button_command(buttonevent, previous=None):
+    """ Command a switch buttonevent sends, None if it should not send one
+
+    A button that is held repeats its command. The short release that follows an
+    initial press already seen in `previous` is not sent again.
+    """
+    if buttonevent is None:
+        return None
+    if buttonevent in TAP_BUTTONS:
+        return TAP_BUTTONS[buttonevent]
+    button, event = divmod(buttonevent, 1000)
+    command = ZLL_BUTTONS.get(button)
+    if command is None:
+        return None
+    if event == INITIAL_PRESS:
+        return command
+    if event == HOLD:
+        return command if command in ['BRT', 'DIM'] else None
+    if event == SHORT_RELEASE:
+        return None if previous == button * 1000 + INITIAL_PRESS else command
+    return None
+
+
+class ButtonPoller(object):
+    """ Polls a bridge's sensors at a sub-second interval for switch button events
+
+    Uses its own keep-alive connection, so it neither waits for nor delays regular
+    polls and commands. Only lastupdated and buttonevent of the hub's switch nodes
+    are looked at, the nodes are called only when those change.
+    """
+
+    def __init__(self, controller, hub_idx, host, username, interval):
+        self.controller = controller
+        self.hub_idx = hub_idx
+        self.username = username
+        self.interval = interval
+        if ':' in host:
+            self.host, port = host.rsplit(':', 1)
+            self.port = int(port)
+        else:
+            self.host = host
+            self.port = 80
+        self.json_load = phue.json_loader(controller.json_library)[1]
+        self.polls = 0
+        self.events = 0
+        self.errors = 0
+        self.stopping = threading.Event()
+        self.connection = None
+        self.thread = None
+
+    def __repr__(self):
+        return '<{0}.{1} hub="{2}" interval={3} polls={4} events={5} errors={6}>'.format(
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self.hub_idx,
+            self.interval,
+            self.polls,
+            self.events,
+            self.errors)
+
+    def start(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name='HueButtons-{}'.format(self.hub_idx), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self._close()
+
+    def _close(self):
+        connection = self.connection
+        self.connection = None
+        if connection is not None:
+            connection.close()
+
+    def _fetch(self):
+        """ Current sensors of the bridge, reusing the open connection """
+        if self.connection is None:
+            self.connection = httplib.HTTPConnection(self.host, self.port, timeout=BUTTON_TIMEOUT)
+            self.connection.connect()
+            self.connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connection.request('GET', '/api/{}/sensors'.format(self.username))
+        response = self.connection.getresponse()
+        sensors = self.json_load(response)
+        if response.will_close:
+            self._close()
+        return sensors
+
+    def _run(self):
+        delay = 1
+        while not self.stopping.is_set():
+            switches = self.controller.switchNodes(self.hub_idx)
+            if len(switches) == 0:
+                self.stopping.wait(IDLE_INTERVAL)
+                continue
+            started = time.time()
+            try:
+                sensors = self._fetch()
+            except (httplib.HTTPException, socket.error, ValueError) as ex:
+                self._close()
+                self.errors += 1
+                if not self.stopping.is_set():
+                    LOGGER.error('Hub {} button poll error: {}'.format(self.hub_idx, ex))
+                self.stopping.wait(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                continue
+            delay = 1
+            self.polls += 1
+            if isinstance(sensors, dict):
+                for sensor_id, node in switches.items():
+                    state = sensors.get(sensor_id, {}).get('state')
+                    if state is not None and node.buttonEvent(state.get('lastupdated'), state.get('buttonevent')):
+                        self.events += 1
+            self.stopping.wait(max(0, self.interval - (time.time() - started)))
+        self._close()
@@ -0,0 +1,151 @@
+""" pytest setup, runs the node server on an in-memory polyinterface and simulated bridges """
+
+import json
+import logging
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+""" (address, command) of every reportCmd call since the reported_commands fixture was set up """
+REPORTED_COMMANDS = []
+
+
+class StubNode(object):
+    """ Enough of polyinterface.Node to run the node classes without Polyglot """
+
+    def __init__(self, controller, primary, address, name):
+        self.controller = controller
+        self.primary = primary
+        self.address = address
+        self.name = name
+        self.drivers = [dict(driver) for driver in self.drivers]
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None):
+        for entry in self.drivers:
+            if entry['driver'] == driver:
+                entry['value'] = value
+                break
+
+    def getDriver(self, driver):
+        for entry in self.drivers:
+            if entry['driver'] == driver:
+                return entry['value']
+        return None
+
+    def reportDrivers(self):
+        pass
+
+    def reportCmd(self, command, value=None, uom=None):
+        REPORTED_COMMANDS.append((self.address, command))
+
+    def start(self):
+        pass
+
+    def query(self, command=None):
+        pass
+
+    drivers = []
+
+
+class StubController(StubNode):
+    """ Enough of polyinterface.Controller to run Control without Polyglot """
+
+    def __init__(self, poly):
+        self.poly = poly
+        self.controller = self
+        self.nodes = {}
+        self.polyConfig = {'customParams': {}, 'customData': {}}
+        self.drivers = [dict(driver) for driver in self.drivers]
+
+    def addNode(self, node, update=False):
+        new = node.address not in self.nodes
+        self.nodes[node.address] = node
+        if new:
+            node.start()
+        return node
+
+    def delNode(self, address):
+        self.nodes.pop(address, None)
+
+    def addNotice(self, data, key=None):
+        pass
+
+    def removeNoticesAll(self):
+        pass
+
+    def saveCustomData(self, data):
+        self.polyConfig['customData'] = data
+
+
+def stub_polyinterface():
+    module = types.ModuleType('polyinterface')
+    module.LOGGER = logging.getLogger('polyinterface')
+    module.Node = StubNode
+    module.Controller = StubController
+    module.Interface = object
+    sys.modules['polyinterface'] = module
+
+
+''' Before any test module imports hue or node_types '''
+stub_polyinterface()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('Timed out waiting for the node server')
+        time.sleep(0.005)
+
+
+def discovery_idle():
+    return not any(thread.name.startswith('HueDiscover-') for thread in threading.enumerate())
+
+
+@pytest.fixture
+def reported_commands():
+    del REPORTED_COMMANDS[:]
+    return REPORTED_COMMANDS
+
+
+@pytest.fixture
+def simulator():
+    """ start(**options) runs a simulated bridge, returns (address, SimBridge) """
+    import hue_sim
+    servers = []
+
+    def start(**options):
+        server, bridge = hue_sim.start_simulator(port=0, serial=len(servers), **options)
+        servers.append(server)
+        return '{}:{}'.format(*server.server_address), bridge
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+@pytest.fixture
+def control():
+    """ start(addresses, **params) runs the node server against bridges until discovery is done """
+    import hue
+    import hue_sim
+    controls = []
+
+    def start(addresses, **params):
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        params = {name: str(value) for name, value in params.items()}
+        params['bridges'] = json.dumps(addresses)
+        controller = hue.Control(None)
+        controller.polyConfig['customParams'] = params
+        controller.polyConfig['customData'] = {'bridges': {str(idx): {'ip': address, 'user': hue_sim.SIM_USER}
+                                                           for idx, address in enumerate(addresses)}}
+        controls.append(controller)
+        controller.start()
+        wait_for(discovery_idle, 10)
+        return controller
+    yield start
+    for controller in controls:
+        controller.stop()
@@ -1,5 +1,12 @@
 """ Generic conversion utilities used by the Hue Node Server. """
 
+import colorsys
+import itertools
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def id_2_addr(hue_id):
     """ Convert a Phillips Hue ID to ISY Address """
@@ -9,8 +16,8 @@ def id_2_addr(hue_id):
 # Taken from: http://www.cse.unr.edu/~quiroz/inc/colortransforms.py
 # License: Code is given as is. Use at your own risk and discretion.
 # pylint: disable=invalid-name
-def RGB_2_xy(R, G, B):
-    """ Convert from RGB color to XY color. """
+def _RGB_2_xy(R, G, B):
+    """ Convert from RGB color to XY color, used for values outside of the lookup tables """
     if R + G + B == 0:
         return 0, 0
 
@@ -75,17 +82,249 @@ colors = {
  }
 
 
+def _linear(value):
+    """ sRGB channel 0-255 to linear value 0-100, same steps as _RGB_2_xy """
+    var = (value / 255.)
+    if var > 0.04045:
+        var = ((var + 0.055) / 1.055) ** 2.4
+    else:
+        var /= 12.92
+    return var * 100
+
+
+""" Each channel's (X, Y, Z) contribution for channel values 0-255 """
+_LINEAR = [_linear(value) for value in range(256)]
+_RED = {value: (var * 0.4124, var * 0.2126, var * 0.0193) for value, var in enumerate(_LINEAR)}
+_GREEN = {value: (var * 0.3576, var * 0.7152, var * 0.1192) for value, var in enumerate(_LINEAR)}
+_BLUE = {value: (var * 0.1805, var * 0.0722, var * 0.9505) for value, var in enumerate(_LINEAR)}
+
+
+def RGB_2_xy(R, G, B):
+    """ Convert from RGB color to XY color. """
+    red = _RED.get(R)
+    green = _GREEN.get(G)
+    blue = _BLUE.get(B)
+    if red is None or green is None or blue is None:
+        return _RGB_2_xy(R, G, B)
+    if R + G + B == 0:
+        return 0, 0
+    X = red[0] + green[0] + blue[0]
+    Y = red[1] + green[1] + blue[1]
+    Z = red[2] + green[2] + blue[2]
+    return round(X / (X + Y + Z), 4), round(Y / (X + Y + Z), 4)
+
+
+""" XY values of the named colors """
+_COLOR_XY = {c_id: _RGB_2_xy(*color[1]) for c_id, color in colors.items()}
+
+
 def color_xy(c_id):
     """ Lookup a color and return the XY values for that color. """
-    return RGB_2_xy(*colors[c_id][1])
+    return _COLOR_XY[c_id]
 
 
-def bri2st(bri):
+def _bri2st(bri):
     return round(bri / 254. * 100., 4)
 
 
-def kel2mired(value):
+def _kel2mired(value):
     if value != 0:
         return int(round(1e6 / value))
     else:
         return 0
+
+
+""" Status for every bridge brightness, mireds for kelvin up to the editor maximum and the reverse """
+_BRI_ST = [_bri2st(bri) for bri in range(255)]
+_KEL_MIRED = [_kel2mired(value) for value in range(6501)]
+
+
+def bri2st(bri):
+    if type(bri) is int and 0 <= bri <= 254:
+        return _BRI_ST[bri]
+    return _bri2st(bri)
+
+
+def kel2mired(value):
+    """ Convert kelvin to mireds or mireds to kelvin """
+    if type(value) is int and 0 <= value <= 6500:
+        return _KEL_MIRED[value]
+    return _kel2mired(value)
+
+
+def lightlevel2lux(lightlevel):
+    """ Convert Hue sensor light level (10000 * log10(lux) + 1) to lux """
+    return round(10 ** ((lightlevel - 1) / 10000.), 1)
+
+
+""" Color gamut triangles (red, green, blue corners in xy) of Hue bulbs """
+GAMUTS = {
+    'A': ((0.704, 0.296), (0.2151, 0.7106), (0.138, 0.08)),
+    'B': ((0.675, 0.322), (0.409, 0.518), (0.167, 0.04)),
+    'C': ((0.6915, 0.3083), (0.17, 0.7), (0.1532, 0.0475))
+}
+
+""" Gamut of bulbs that do not report it in their capabilities """
+MODEL_GAMUTS = {
+    'LST001': 'A', 'LLC005': 'A', 'LLC006': 'A', 'LLC007': 'A', 'LLC010': 'A', 'LLC011': 'A',
+    'LLC012': 'A', 'LLC013': 'A', 'LLC014': 'A',
+    'LCT001': 'B', 'LCT002': 'B', 'LCT003': 'B', 'LCT007': 'B', 'LLM001': 'B',
+    'LCT010': 'C', 'LCT011': 'C', 'LCT012': 'C', 'LCT014': 'C', 'LCT015': 'C', 'LCT016': 'C',
+    'LLC020': 'C', 'LST002': 'C'
+}
+
+""" Batches at least this long are converted with NumPy if it is available """
+NUMPY_MIN_BATCH = 32
+
+_GAMUT_CACHE = {}
+
+
+def light_gamut(light):
+    """ Gamut triangle of a light from its bridge data, None if it is unknown or not a color light
+
+    Read from the light's capabilities, or looked up by model id, and cached per model.
+    """
+    model = light.get('modelid')
+    if model in _GAMUT_CACHE:
+        return _GAMUT_CACHE[model]
+    control = light.get('capabilities', {}).get('control', {})
+    gamut = None
+    if 'colorgamut' in control:
+        gamut = tuple(tuple(corner) for corner in control['colorgamut'])
+    elif control.get('colorgamuttype') in GAMUTS:
+        gamut = GAMUTS[control['colorgamuttype']]
+    elif model in MODEL_GAMUTS:
+        gamut = GAMUTS[MODEL_GAMUTS[model]]
+    if model is not None:
+        _GAMUT_CACHE[model] = gamut
+    return gamut
+
+
+def _closest_on_edge(ax, ay, bx, by, x, y):
+    """ Point on the segment from a to b closest to (x, y) """
+    dx = bx - ax
+    dy = by - ay
+    t = ((x - ax) * dx + (y - ay) * dy) / (dx * dx + dy * dy)
+    t = min(1., max(0., t))
+    return ax + t * dx, ay + t * dy
+
+
+def clamp_xy(xy, gamut):
+    """ Move an xy color to the closest point inside the gamut triangle, None gamut leaves it unchanged """
+    if gamut is None:
+        return xy
+    x, y = xy
+    (rx, ry), (gx, gy), (bx, by) = gamut
+    cross = (gx - rx) * (by - ry) - (gy - ry) * (bx - rx)
+    s = ((x - rx) * (by - ry) - (y - ry) * (bx - rx)) / cross
+    t = ((gx - rx) * (y - ry) - (gy - ry) * (x - rx)) / cross
+    if s >= 0 and t >= 0 and s + t <= 1:
+        return xy
+    best = None
+    for ax, ay, cx, cy in [(rx, ry, gx, gy), (gx, gy, bx, by), (bx, by, rx, ry)]:
+        px, py = _closest_on_edge(ax, ay, cx, cy, x, y)
+        distance = (px - x) ** 2 + (py - y) ** 2
+        if best is None or distance < best[0]:
+            best = (distance, px, py)
+    return round(best[1], 4), round(best[2], 4)
+
+
+def _hsb_2_rgb(hue, sat):
+    """ Hue (0-65535) and saturation (0-254) to RGB 0-255 at full brightness """
+    red, green, blue = colorsys.hsv_to_rgb((hue % 65536) / 65536., min(254, max(0, sat)) / 254., 1.)
+    return int(round(red * 255)), int(round(green * 255)), int(round(blue * 255))
+
+
+def _ct_2_xy(mired):
+    """ xy of a color temperature in mireds on the Planckian locus (Kim et al. cubic spline) """
+    kelvin = min(25000., max(1667., 1e6 / mired))
+    if kelvin <= 4000:
+        x = -0.2661239e9 / kelvin ** 3 - 0.2343589e6 / kelvin ** 2 + 0.8776956e3 / kelvin + 0.179910
+    else:
+        x = -3.0258469e9 / kelvin ** 3 + 2.1070379e6 / kelvin ** 2 + 0.2226347e3 / kelvin + 0.240390
+    if kelvin <= 2222:
+        y = -1.1063814 * x ** 3 - 1.34811020 * x ** 2 + 2.18555832 * x - 0.20219683
+    elif kelvin <= 4000:
+        y = -0.9549476 * x ** 3 - 1.37418593 * x ** 2 + 2.09137015 * x - 0.16748867
+    else:
+        y = 3.0817580 * x ** 3 - 5.87338670 * x ** 2 + 3.75112997 * x - 0.37001483
+    return round(x, 4), round(y, 4)
+
+
+def _numpy_round(values):
+    """ round(value, 4) of every value, falling back to round() where the last digit is a close call """
+    scaled = values * 1e4
+    rounded = numpy.rint(scaled) / 1e4
+    close = numpy.flatnonzero(numpy.abs(scaled - numpy.floor(scaled) - 0.5) < 1e-6).tolist()
+    rounded = rounded.tolist()
+    for idx in close:
+        rounded[idx] = round(float(values[idx]), 4)
+    return rounded
+
+
+def _numpy_rgb_2_xy(colors):
+    """ x and y lists for a sequence of RGB colors, same steps as RGB_2_xy """
+    if isinstance(colors, numpy.ndarray):
+        rgb = colors.astype(float) / 255.
+    else:
+        rgb = numpy.fromiter(itertools.chain.from_iterable(colors), dtype=float, count=3 * len(colors)).reshape(-1, 3) / 255.
+    rgb = numpy.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92) * 100
+    X = rgb[:, 0] * 0.4124 + rgb[:, 1] * 0.3576 + rgb[:, 2] * 0.1805
+    Y = rgb[:, 0] * 0.2126 + rgb[:, 1] * 0.7152 + rgb[:, 2] * 0.0722
+    Z = rgb[:, 0] * 0.0193 + rgb[:, 1] * 0.1192 + rgb[:, 2] * 0.9505
+    total = X + Y + Z
+    black = total == 0
+    total[black] = 1
+    xy = list(zip(_numpy_round(X / total), _numpy_round(Y / total)))
+    for idx in numpy.flatnonzero(black).tolist():
+        xy[idx] = (0, 0)
+    return xy
+
+
+def _numpy_outside(xy, gamut):
+    """ Indices of xy colors outside of the gamut triangle """
+    points = numpy.asarray(xy, dtype=float)
+    (rx, ry), (gx, gy), (bx, by) = gamut
+    cross = (gx - rx) * (by - ry) - (gy - ry) * (bx - rx)
+    s = ((points[:, 0] - rx) * (by - ry) - (points[:, 1] - ry) * (bx - rx)) / cross
+    t = ((gx - rx) * (points[:, 1] - ry) - (gy - ry) * (points[:, 0] - rx)) / cross
+    return numpy.flatnonzero((s < 0) | (t < 0) | (s + t > 1)).tolist()
+
+
+def _clamp_all(xy, gamut, gamuts):
+    """ Clamp xy colors to one gamut for all of them or to a gamut per color """
+    if gamuts is not None:
+        if len(gamuts) != len(xy):
+            raise ValueError('Expected {} gamuts, got {}'.format(len(xy), len(gamuts)))
+        return [clamp_xy(color, color_gamut) for color, color_gamut in zip(xy, gamuts)]
+    if gamut is None:
+        return xy
+    if numpy is not None and len(xy) >= NUMPY_MIN_BATCH:
+        for idx in _numpy_outside(xy, gamut):
+            xy[idx] = clamp_xy(xy[idx], gamut)
+        return xy
+    return [clamp_xy(color, gamut) for color in xy]
+
+
+def rgb_to_xy(colors, gamut=None, gamuts=None):
+    """ Convert a sequence of (R, G, B) colors to xy
+
+    Colors are clamped to `gamut`, or to gamuts[i] for colors[i] when converting for
+    several lights at once, e.g. a gradient across a group. Without a gamut the
+    results are the same as RGB_2_xy.
+    """
+    if numpy is not None and len(colors) >= NUMPY_MIN_BATCH:
+        xy = _numpy_rgb_2_xy(colors)
+    else:
+        xy = [RGB_2_xy(*color) for color in colors]
+    return _clamp_all(xy, gamut, gamuts)
+
+
+def hsb_to_xy(colors, gamut=None, gamuts=None):
+    """ Convert a sequence of (hue, sat) or (hue, sat, bri) bridge values to xy, brightness does not change xy """
+    return rgb_to_xy([_hsb_2_rgb(color[0], color[1]) for color in colors], gamut, gamuts)
+
+
+def ct_to_xy(mireds, gamut=None, gamuts=None):
+    """ Convert a sequence of color temperatures in mireds to xy """
+    return _clamp_all([_ct_2_xy(mired) for mired in mireds], gamut, gamuts)
@@ -0,0 +1,178 @@
+""" Background command dispatch used by the Hue Node Server. """
+
+import polyinterface
+import json
+import queue
+import threading
+
+LOGGER = polyinterface.LOGGER
+
+
+class CommandDispatcher(object):
+    """ Per-bridge worker sending node commands in the background
+
+    Nodes update their drivers optimistically and hand the bridge request over to
+    the worker, which sends requests in the order they were submitted and asks the
+    node to reconcile its drivers if the bridge reports a failure.
+    """
+
+    def __init__(self, hub_idx):
+        self.hub_idx = hub_idx
+        self.queue = queue.Queue()
+        self.sent = 0
+        self.failed = 0
+        self.thread = None
+
+    def __repr__(self):
+        return '<{0}.{1} hub="{2}" queued={3} sent={4} failed={5}>'.format(
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self.hub_idx,
+            self.queue.qsize(),
+            self.sent,
+            self.failed)
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name='HueDispatch-{}'.format(self.hub_idx), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+
+    def submit(self, node, command):
+        node._commandQueued()
+        self.queue.put((node, command))
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'sent': self.sent, 'failed': self.failed}
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            node, command = item
+            try:
+                success = node._put(command)
+            except Exception as ex:
+                LOGGER.error('Hub {} {} command {} failed: {}'.format(self.hub_idx, node.name, command, ex))
+                success = False
+            self.sent += 1
+            try:
+                if not success:
+                    self.failed += 1
+                    node._commandFailed(command)
+            finally:
+                node._commandDone()
+
+
+class GroupBatcher(object):
+    """ Collapses bursts of identical light commands into a single group action
+
+    Light commands are held for a short window. If the lights that received the same
+    command exactly match an existing Hue group, the command is sent to that group
+    once instead of to every light; otherwise each light command is sent as usual.
+    """
+
+    def __init__(self, controller, window):
+        self.controller = controller
+        self.window = window
+        self.pending = {}
+        self.collapsed = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{0}.{1} window={2} pending={3} collapsed={4}>'.format(
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self.window,
+            len(self.pending),
+            self.collapsed)
+
+    def submit(self, node, command):
+        key = (node.hub_idx, json.dumps(command, sort_keys=True))
+        node._commandQueued()
+        with self.lock:
+            batch = self.pending.setdefault(key, [])
+            if len(batch) == 0:
+                timer = threading.Timer(self.window / 1000., self._flush, [key])
+                timer.daemon = True
+                timer.start()
+            batch.append((node, command))
+        return True
+
+    def _flush(self, key):
+        with self.lock:
+            batch = self.pending.pop(key, [])
+        try:
+            self._send(key[0], batch)
+        finally:
+            for node, command in batch:
+                node._commandDone()
+
+    def _send(self, hub_idx, batch):
+        light_ids = set(str(node.element_id) for node, command in batch)
+        group_id = None
+        if len(light_ids) > 1:
+            group_id = self.controller.groupCovering(hub_idx, light_ids)
+        if group_id is None:
+            for node, command in batch:
+                self._sendLight(hub_idx, node, command)
+            return
+        command = batch[-1][1]
+        LOGGER.info('Hub {} sending {} to group {} instead of {} lights'.format(hub_idx, command, group_id, len(light_ids)))
+        self.collapsed += 1
+        group = GroupCommand(self.controller, hub_idx, group_id, batch)
+        dispatcher = self.controller.dispatchers.get(hub_idx)
+        if dispatcher is not None:
+            ''' Keep the order of commands to the hub and its rate limiting in one place '''
+            dispatcher.submit(group, command)
+            return
+        try:
+            success = group._put(command)
+        except Exception as ex:
+            LOGGER.error('Hub {} {} command {} failed: {}'.format(hub_idx, group.name, command, ex))
+            success = False
+        if not success:
+            group._commandFailed(command)
+
+
+    def _sendLight(self, hub_idx, node, command):
+        """ Send one light's command, a failure must not keep the rest of the batch from being sent """
+        try:
+            success = node._dispatch(command, False)
+        except Exception as ex:
+            LOGGER.error('Hub {} {} command {} failed: {}'.format(hub_idx, node.name, command, ex))
+            success = False
+        if not success:
+            node._commandFailed(command)
+
+
+class GroupCommand(object):
+    """ Light commands collapsed into one group command, sent by a dispatcher like a node command """
+
+    def __init__(self, controller, hub_idx, group_id, batch):
+        self.controller = controller
+        self.hub_idx = hub_idx
+        self.group_id = group_id
+        self.batch = batch
+        self.name = 'group {}'.format(group_id)
+
+    def _put(self, command):
+        self.controller.pollBoost(self.hub_idx)
+        responses = self.controller.hub[self.hub_idx].set_group(int(self.group_id), command)
+        return all([list(resp.keys())[0] == 'success' for resp in responses[0]])
+
+    def _commandQueued(self):
+        for node, node_command in self.batch:
+            node._commandQueued()
+
+    def _commandDone(self):
+        for node, node_command in self.batch:
+            node._commandDone()
+
+    def _commandFailed(self, command):
+        for node, node_command in self.batch:
+            node._commandFailed(node_command)
@@ -0,0 +1,358 @@
+""" Light effects driven by the Hue Node Server. """
+
+import polyinterface
+import heapq
+import random
+import threading
+import time
+
+LOGGER = polyinterface.LOGGER
+
+""" Effects in the order of the FX_START effect selector """
+EFFECTS = ['candle', 'breathe', 'sunrise', 'chase']
+
+""" Default sunrise length in seconds """
+DEF_SUNRISE = 600
+
+""" Warm candle and sunrise colors """
+CANDLE_XY = (0.57, 0.40)
+SUNRISE_START_XY = (0.675, 0.322)
+SUNRISE_END_XY = (0.4575, 0.4099)
+
+
+class Effect(object):
+    """ Base class of effects, frames are lists of (resource, id, command) to send
+
+    Each frame is sent with a transition lasting until the next frame, so effects
+    stay smooth when the engine has to slow them down to fit the bridge budget.
+    """
+
+    """ Seconds between frames when the bridge budget allows it """
+    interval = 1.
+    """ Effect drives member lights of a group one by one instead of the group itself """
+    per_light = False
+
+    def __init__(self, node, duration=0):
+        self.node = node
+        self.hub_idx = node.hub_idx
+        self.duration = duration
+        self.started = time.time()
+        self.step = 0
+        self.scale = 1.
+        self.targets = self._targets()
+        self.nodes = self._nodes()
+
+    def __repr__(self):
+        return '<{0}.{1} node="{2}" step={3} scale={4:.1f}>'.format(
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self.node.address,
+            self.step,
+            self.scale)
+
+    def _targets(self):
+        """ (resource, id, state) of every light or group the effect sends commands to """
+        controller = self.node.controller
+        if hasattr(self.node, 'all_on'):
+            if not self.per_light:
+                return [('groups', str(self.node.element_id), self.node.data.get('action', {}))]
+            lights = controller.lights.get(self.hub_idx) or {}
+            return [('lights', light_id, lights[light_id]['state'])
+                    for light_id in self.node.data.get('lights', []) if light_id in lights]
+        return [('lights', str(self.node.element_id), self.node.data.get('state', {}))]
+
+    def _nodes(self):
+        """ Node of each (resource, id) target, whose drivers follow the commands sent to it """
+        own = ('groups' if hasattr(self.node, 'all_on') else 'lights', str(self.node.element_id))
+        nodes = {own: self.node}
+        if own[0] == 'groups' and self.per_light:
+            targets = set((resource, target_id) for resource, target_id, state in self.targets)
+            for node in list(self.node.controller.hub_nodes.get(self.hub_idx, {}).values()):
+                key = ('lights', str(getattr(node, 'element_id', '')))
+                if key in targets and hasattr(node, '_reportCommand') and not hasattr(node, 'all_on'):
+                    nodes[key] = node
+        return nodes
+
+    def report(self, resource, target_id, command):
+        """ Update drivers of the nodes a sent command changed """
+        node = self.nodes.get((resource, target_id))
+        if node is not None:
+            node._reportCommand(command)
+        if node is not self.node and command.get('on'):
+            ''' A group driving its lights one by one is on too '''
+            self.node._reportCommand({'on': True})
+
+    def cost(self):
+        """ Average (light, group) commands per frame """
+        lights = sum(1 for resource, target_id, state in self.targets if resource == 'lights')
+        return lights, len(self.targets) - lights
+
+    def current_interval(self):
+        return self.interval * self.scale
+
+    def next_frame(self):
+        """ Commands of the next frame, None once the effect is over """
+        if self.duration > 0 and time.time() - self.started >= self.duration:
+            return None
+        frame = self.frame(self.step, int(round(self.current_interval() * 10)))
+        self.step += 1
+        return frame
+
+    def frame(self, step, transition):
+        return []
+
+
+class Candle(Effect):
+    """ Every light flickers independently around a warm, dimmed level
+
+    Lights get their next flicker one after another rather than all at once, so the
+    bridge sees a steady trickle of commands instead of bursts.
+    """
+
+    """ Seconds between flickers of each light """
+    flicker = 0.5
+    per_light = True
+
+    def __init__(self, node, duration=0):
+        super().__init__(node, duration)
+        self.interval = self.flicker / max(1, len(self.targets))
+
+    def cost(self):
+        return 1, 0
+
+    def frame(self, step, transition):
+        resource, target_id, state = self.targets[step % len(self.targets)]
+        command = {'bri': random.randint(90, 200), 'transitiontime': transition * len(self.targets)}
+        if step < len(self.targets):
+            command['on'] = True
+            if 'ct' in state:
+                command['ct'] = 454
+            elif 'xy' in state:
+                command['xy'] = list(CANDLE_XY)
+        elif 'ct' in state:
+            command['ct'] = random.randint(440, 500)
+        return [(resource, target_id, command)]
+
+
+class Breathe(Effect):
+    """ Brightness slowly rises and falls """
+
+    interval = 2.
+
+    def __init__(self, node, duration=0):
+        super().__init__(node, duration)
+        ''' Brightness when started, the node's own follows the frames sent '''
+        self.high = max(1, node.brightness or 254)
+
+    def frame(self, step, transition):
+        level = self.high if step % 2 == 0 else max(1, self.high // 5)
+        command = {'bri': level, 'transitiontime': transition}
+        if step == 0:
+            command['on'] = True
+        return [(resource, target_id, dict(command)) for resource, target_id, state in self.targets]
+
+
+class Sunrise(Effect):
+    """ Light comes up from a dim red to full warm white over the effect duration """
+
+    steps = 10
+
+    def __init__(self, node, duration=0):
+        super().__init__(node, duration if duration > 0 else DEF_SUNRISE)
+        self.interval = float(self.duration) / self.steps
+        ''' Finishes on its own after the last step '''
+        self.duration = 0
+
+    def frame(self, step, transition):
+        if step > self.steps:
+            return None
+        progress = float(step) / self.steps
+        frame = []
+        for resource, target_id, state in self.targets:
+            command = {'bri': max(1, int(round(254 * progress))), 'transitiontime': 0 if step == 0 else transition}
+            if step == 0:
+                command['on'] = True
+            if 'xy' in state:
+                command['xy'] = [round(start + (end - start) * progress, 4)
+                                 for start, end in zip(SUNRISE_START_XY, SUNRISE_END_XY)]
+            elif 'ct' in state:
+                command['ct'] = int(round(500 - 250 * progress))
+            frame.append((resource, target_id, command))
+        return frame
+
+
+class Chase(Effect):
+    """ A bright spot moves across the lights of a group
+
+    Lights are dimmed one per frame before the spot starts moving, so no frame
+    sends more than the two commands cost() accounts for.
+    """
+
+    interval = 1.
+    per_light = True
+
+    def cost(self):
+        return min(2, len(self.targets)), 0
+
+    def frame(self, step, transition):
+        if len(self.targets) == 0:
+            return None
+        count = len(self.targets)
+        if step < count:
+            resource, target_id, state = self.targets[step]
+            return [(resource, target_id, {'on': True, 'bri': 20, 'transitiontime': 0})]
+        frame = []
+        current = self.targets[step % count]
+        frame.append((current[0], current[1], {'bri': 254, 'transitiontime': transition}))
+        if count > 1 and step > count:
+            previous = self.targets[(step - 1) % count]
+            frame.append((previous[0], previous[1], {'bri': 20, 'transitiontime': transition}))
+        return frame
+
+
+EFFECT_CLASSES = {'candle': Candle, 'breathe': Breathe, 'sunrise': Sunrise, 'chase': Chase}
+
+
+class EffectsEngine(object):
+    """ Runs effects of all nodes from one thread within a per-bridge command budget
+
+    `light_rate` and `group_rate` are the light and group commands per second effects
+    may send to each bridge, leaving the rest of the bridge limits to other commands.
+    When the effects of a bridge would need more, all of them are slowed down evenly.
+    """
+
+    def __init__(self, controller, light_rate, group_rate):
+        self.controller = controller
+        self.light_rate = light_rate
+        self.group_rate = group_rate
+        self.effects = {}
+        self.queue = []
+        self.counter = 0
+        self.sent = 0
+        self.failed = 0
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopping = False
+
+    def __repr__(self):
+        return '<{0}.{1} running={2} sent={3} failed={4}>'.format(
+            self.__class__.__module__,
+            self.__class__.__name__,
+            len(self.effects),
+            self.sent,
+            self.failed)
+
+    def start(self, node, name, duration=0):
+        if name not in EFFECT_CLASSES:
+            LOGGER.error('{} unknown effect {}'.format(node.name, name))
+            return False
+        effect = EFFECT_CLASSES[name](node, duration)
+        if len(effect.targets) == 0:
+            LOGGER.error('{} has no lights for effect {}'.format(node.name, name))
+            return False
+        LOGGER.info('{} starting effect {}'.format(node.name, name))
+        with self.condition:
+            self.effects[node.address] = effect
+            self._rescale(effect.hub_idx)
+            self._schedule(time.time(), effect)
+            if self.thread is None or not self.thread.is_alive():
+                self.stopping = False
+                self.thread = threading.Thread(target=self._run, name='HueEffects', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return True
+
+    def stop(self, node):
+        """ Stop the node's effect, lights stay as they are. Returns True if one was running """
+        with self.condition:
+            effect = self.effects.pop(node.address, None)
+            if effect is None:
+                return False
+            self._rescale(effect.hub_idx)
+        LOGGER.info('{} effect stopped'.format(node.name))
+        self._settle(effect)
+        return True
+
+    def running(self, node):
+        return node.address in self.effects
+
+    def stop_all(self):
+        with self.condition:
+            self.effects = {}
+            self.queue = []
+            self.stopping = True
+            self.condition.notify()
+
+    def _schedule(self, due, effect):
+        self.counter += 1
+        heapq.heappush(self.queue, (due, self.counter, effect))
+
+    def _rescale(self, hub_idx):
+        """ Slow down the hub's effects evenly if together they need more commands than the budget """
+        effects = [effect for effect in self.effects.values() if effect.hub_idx == hub_idx]
+        light_demand = sum(effect.cost()[0] / effect.interval for effect in effects)
+        group_demand = sum(effect.cost()[1] / effect.interval for effect in effects)
+        light_scale = max(1., light_demand / self.light_rate if self.light_rate > 0 else 1.)
+        group_scale = max(1., group_demand / self.group_rate if self.group_rate > 0 else 1.)
+        for effect in effects:
+            lights, groups = effect.cost()
+            effect.scale = max(light_scale if lights > 0 else 1., group_scale if groups > 0 else 1.)
+        if light_scale > 1 or group_scale > 1:
+            LOGGER.debug('Hub {} effects slowed down {:.1f}x (lights) and {:.1f}x (groups) to stay within the bridge budget'.format(
+                hub_idx, light_scale, group_scale))
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.stopping:
+                    if len(self.queue) == 0:
+                        self.condition.wait()
+                        continue
+                    due, counter, effect = self.queue[0]
+                    wait = due - time.time()
+                    if wait <= 0:
+                        heapq.heappop(self.queue)
+                        break
+                    self.condition.wait(wait)
+                if self.stopping:
+                    return
+                if self.effects.get(effect.node.address) is not effect:
+                    continue
+                frame = effect.next_frame()
+                if frame is None:
+                    self.effects.pop(effect.node.address, None)
+                    self._rescale(effect.hub_idx)
+                else:
+                    self._schedule(max(due + effect.current_interval(), time.time()), effect)
+            if frame is None:
+                LOGGER.info('{} effect finished'.format(effect.node.name))
+                self._settle(effect)
+                continue
+            self._send(effect, frame)
+
+    def _settle(self, effect):
+        """ Have the next poll report where the effect left the lights soon """
+        for node in effect.nodes.values():
+            node.fingerprint = None
+        self.controller.pollBoost(effect.hub_idx)
+
+    def _send(self, effect, frame):
+        hub_idx = effect.hub_idx
+        hub = self.controller.hub.get(hub_idx)
+        if hub is None:
+            return
+        for resource, target_id, command in frame:
+            try:
+                if resource == 'groups':
+                    responses = hub.set_group(int(target_id), command)
+                else:
+                    responses = hub.set_light(int(target_id), command)
+                success = all([list(resp.keys())[0] == 'success' for resp in responses[0]])
+            except Exception as ex:
+                LOGGER.error('Hub {} effect command {} to {} {} failed: {}'.format(hub_idx, command, resource, target_id, ex))
+                success = False
+            self.sent += 1
+            if success:
+                effect.report(resource, target_id, command)
+            else:
+                self.failed += 1
@@ -0,0 +1,167 @@
+""" Bridge event stream listener used by the Hue Node Server. """
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+import polyinterface
+import json
+import socket
+import ssl
+import threading
+
+LOGGER = polyinterface.LOGGER
+
+""" CLIP v2 server-sent events endpoint """
+EVENT_PATH = '/eventstream/clip/v2'
+""" Seconds without any data, including keep-alives, before the stream is reconnected """
+EVENT_TIMEOUT = 120
+""" Longest wait between reconnection attempts """
+MAX_RECONNECT_DELAY = 60
+
+
+def v1_update(resource):
+    """ Translate a CLIP v2 resource update into (resource type, v1 id, v1 state changes) """
+    id_v1 = resource.get('id_v1')
+    if not id_v1:
+        return None
+    parts = id_v1.strip('/').split('/')
+    if len(parts) != 2 or parts[0] not in ['lights', 'groups']:
+        return None
+    state = {}
+    if 'on' in resource:
+        state['on'] = resource['on']['on']
+    if 'dimming' in resource:
+        state['bri'] = max(1, min(254, int(round(resource['dimming']['brightness'] * 2.54))))
+    if 'color_temperature' in resource and resource['color_temperature'].get('mirek') is not None:
+        state['ct'] = resource['color_temperature']['mirek']
+    if 'color' in resource and 'xy' in resource['color']:
+        state['xy'] = [resource['color']['xy']['x'], resource['color']['xy']['y']]
+    if resource.get('type') == 'zigbee_connectivity' and 'status' in resource:
+        state['reachable'] = resource['status'] == 'connected'
+    if len(state) == 0:
+        return None
+    return parts[0], parts[1], state
+
+
+class EventStream(object):
+    """ Long-lived connection to a bridge's CLIP v2 event stream
+
+    Updates received from the bridge are translated to v1 light and group state
+    and handed to the controller, so changes made outside of the ISY show up
+    without waiting for the next poll.
+    """
+
+    def __init__(self, controller, hub_idx, host, username, secure=True):
+        self.controller = controller
+        self.hub_idx = hub_idx
+        self.username = username
+        self.secure = secure
+        if ':' in host:
+            self.host, port = host.rsplit(':', 1)
+            self.port = int(port)
+        else:
+            self.host = host
+            self.port = 443 if secure else 80
+        self.connected = False
+        self.events = 0
+        self.reconnects = 0
+        self.stopping = threading.Event()
+        self.connection = None
+        self.thread = None
+
+    def __repr__(self):
+        return '<{0}.{1} hub="{2}" connected={3} events={4} reconnects={5}>'.format(
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self.hub_idx,
+            self.connected,
+            self.events,
+            self.reconnects)
+
+    def start(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name='HueEvents-{}'.format(self.hub_idx), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        connection = self.connection
+        if connection is not None:
+            connection.close()
+
+    def _connect(self):
+        if self.secure:
+            """ Bridges use a self-signed certificate """
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            connection = httplib.HTTPSConnection(self.host, self.port, timeout=EVENT_TIMEOUT, context=context)
+        else:
+            connection = httplib.HTTPConnection(self.host, self.port, timeout=EVENT_TIMEOUT)
+        connection.request('GET', EVENT_PATH, headers={'hue-application-key': self.username,
+                                                       'Accept': 'text/event-stream'})
+        response = connection.getresponse()
+        if response.status != 200:
+            connection.close()
+            raise httplib.HTTPException('event stream returned HTTP {}'.format(response.status))
+        self.connection = connection
+        return response
+
+    def _run(self):
+        delay = 1
+        while not self.stopping.is_set():
+            try:
+                response = self._connect()
+                LOGGER.info('Hub {} event stream connected'.format(self.hub_idx))
+                self.connected = True
+                delay = 1
+                self._read(response)
+            except (httplib.HTTPException, socket.error, ssl.SSLError) as ex:
+                if not self.stopping.is_set():
+                    LOGGER.error('Hub {} event stream error: {}'.format(self.hub_idx, ex))
+            finally:
+                self.connected = False
+                if self.connection is not None:
+                    self.connection.close()
+                    self.connection = None
+            if self.stopping.wait(delay):
+                break
+            self.reconnects += 1
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def _read(self, response):
+        """ Parse server-sent events, each event's data lines hold a JSON list of updates """
+        data = []
+        while not self.stopping.is_set():
+            line = response.readline()
+            if not line:
+                LOGGER.info('Hub {} event stream closed by the bridge'.format(self.hub_idx))
+                return
+            line = line.decode('utf-8').rstrip('\r\n')
+            if line.startswith('data:'):
+                data.append(line[5:].strip())
+            elif line == '' and len(data) > 0:
+                self._dispatch('\n'.join(data))
+                data = []
+
+    def _dispatch(self, payload):
+        try:
+            events = json.loads(payload)
+        except ValueError:
+            LOGGER.error('Hub {} event stream sent invalid data: {}'.format(self.hub_idx, payload))
+            return
+        updates = []
+        for event in events:
+            if event.get('type') != 'update':
+                continue
+            for resource in event.get('data', []):
+                update = v1_update(resource)
+                if update is not None:
+                    updates.append(update)
+        self.events += len(updates)
+        if len(updates) > 0:
+            try:
+                self.controller.applyEvents(self.hub_idx, updates)
+            except Exception as ex:
+                LOGGER.error('Hub {} failed to apply events: {}'.format(self.hub_idx, ex))
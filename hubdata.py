@@ -0,0 +1,71 @@
+""" Per-hub bridge data snapshots used by the Hue Node Server. """
+
+import threading
+
+""" Resource classes kept for each hub """
+HUB_RESOURCES = ('lights', 'groups', 'scenes', 'sensors')
+
+
+class HubData(object):
+    """ Lights, groups, scenes and sensors read from one hub
+
+    Never changed once published, an update publishes a changed copy. So discovery
+    hands over everything it read with a single assignment, and nobody sees lights
+    of a new discovery next to groups of the previous one.
+    """
+
+    __slots__ = HUB_RESOURCES
+
+    def __init__(self, lights=None, groups=None, scenes=None, sensors=None):
+        self.lights = lights
+        self.groups = groups
+        self.scenes = scenes
+        self.sensors = sensors
+
+    def replace(self, **changes):
+        values = {resource: getattr(self, resource) for resource in HUB_RESOURCES}
+        values.update(changes)
+        return HubData(**values)
+
+
+class HubStore(object):
+    """ Current HubData of every hub """
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, hub_idx):
+        return self.data.get(hub_idx)
+
+    def update(self, hub_idx, **changes):
+        """ Publish a copy of the hub's data with the given resources replaced """
+        with self.lock:
+            data = self.data.get(hub_idx) or HubData()
+            self.data[hub_idx] = data.replace(**changes)
+
+
+class HubResource(object):
+    """ Dict-like view of one resource of all hubs, e.g. lights[hub_idx] """
+
+    def __init__(self, store, resource):
+        self.store = store
+        self.resource = resource
+
+    def __getitem__(self, hub_idx):
+        data = self.store.get(hub_idx)
+        if data is None:
+            raise KeyError(hub_idx)
+        return getattr(data, self.resource)
+
+    def __setitem__(self, hub_idx, value):
+        self.store.update(hub_idx, **{self.resource: value})
+
+    def __contains__(self, hub_idx):
+        return self.store.get(hub_idx) is not None
+
+    def get(self, hub_idx, default=None):
+        data = self.store.get(hub_idx)
+        if data is None:
+            return default
+        return getattr(data, self.resource)
@@ -7,15 +7,54 @@ try:
 except ImportError:
     from http.client import BadStatusLine  # Python 3.x
 import polyinterface
-from node_types import HueDimmLight, HueWhiteLight, HueColorLight, HueEColorLight, HueGroup
+from node_types import HueDimmLight, HueWhiteLight, HueColorLight, HueEColorLight, HueGroup, project_light, project_group
+from node_types import HueSensor, HueMotionSensor, HueLightLevelSensor, HueTemperatureSensor, HueSwitch, project_sensor
+from node_types import project_scene
+from scheduler import Cadence, POLL_RESOURCES, DEF_CADENCE, DEF_BOOST_WINDOW
+from dispatch import CommandDispatcher, GroupBatcher
+from eventstream import EventStream
+from buttons import ButtonPoller, SWITCH_TYPES, MIN_BUTTON_POLL
+from effects import EffectsEngine
+from hubdata import HubStore, HubResource
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import sys
+import os
 import socket
 import phue
 import logging
 import json
+import random
+import threading
+import time
 
 LOGGER = polyinterface.LOGGER
 
+
+def project_response(address, response):
+    """ Drop the parts of bridge light, group, sensor and scene data nodes do not use, as responses arrive """
+    if not isinstance(response, dict):
+        return response
+    endpoint = phue.request_endpoint(address)
+    if endpoint == 'lights/<id>':
+        return project_light(response)
+    if endpoint == 'groups/<id>':
+        return project_group(response)
+    if endpoint == 'sensors/<id>':
+        return project_sensor(response)
+    if endpoint == 'api':
+        for resource in ('lights', 'groups', 'sensors', 'scenes'):
+            if resource in response:
+                response[resource] = project_response(resource, response[resource])
+    elif endpoint == 'lights':
+        response = {light_id: project_light(light) for light_id, light in response.items()}
+    elif endpoint == 'groups':
+        response = {group_id: project_group(group) for group_id, group in response.items()}
+    elif endpoint == 'sensors':
+        response = {sensor_id: project_sensor(sensor) for sensor_id, sensor in response.items()}
+    elif endpoint == 'scenes':
+        response = {scene_id: project_scene(scene) for scene_id, scene in response.items()}
+    return response
+
 class Control(polyinterface.Controller):
     """ Phillips Hue Node Server """
     
@@ -24,13 +63,50 @@ class Control(polyinterface.Controller):
         self.name = 'Hue Bridge'
         self.address = 'huebridge'
         self.primary = self.address
-        self.discovery = False
+        self.discovery_locks = {}
         self.hub = {}
-        self.lights = {}
-        self.groups = {}
-        self.scenes = {}
-        self.scene_lookup = []
+        self.hub_data = HubStore()
+        self.lights = HubResource(self.hub_data, 'lights')
+        self.groups = HubResource(self.hub_data, 'groups')
+        self.scenes = HubResource(self.hub_data, 'scenes')
+        self.sensors = HubResource(self.hub_data, 'sensors')
+        self.hub_nodes = {}
+        self.scene_index = {}
+        self.scene_locks = {}
+        self.scene_stamps = {}
         self.ignore_second_on = False
+        self.coalesce_window = 0
+        self.async_commands = False
+        self.dispatchers = {}
+        self.batcher = None
+        self.full_poll = False
+        self.pool_size = 2
+        self.pool_idle_timeout = 30
+        self.tcp_nodelay = True
+        self.light_rate = 10.0
+        self.group_rate = 1.0
+        self.poll_workers = 4
+        self.poll_jitter = 0.5
+        self.poll_lock = threading.Lock()
+        self.poll_executor = None
+        self.poll_timings = {}
+        self.fetch_times = {}
+        self.adaptive_poll = False
+        self.poll_cadence = dict(DEF_CADENCE)
+        self.poll_boost_window = DEF_BOOST_WINDOW
+        self.cadences = {}
+        self.scheduler = None
+        self.stopping = threading.Event()
+        self.event_stream = None
+        self.event_streams = {}
+        self.event_poll_interval = 300
+        self.consistency_polls = {}
+        self.last_poll = None
+        self.metrics_file = ''
+        self.json_library = None
+        self.button_poll = 0.
+        self.button_pollers = {}
+        self.effects = None
         LOGGER.info('Started Hue Protocol')
                         
     def start(self):
@@ -41,15 +117,296 @@ class Control(polyinterface.Controller):
         if 'ignore_second_on' in self.polyConfig['customParams']:
             LOGGER.debug('DON will be ignored if already on')
             self.ignore_second_on = True
+        self.coalesce_window = self._getParam('coalesce_window', self.coalesce_window)
+        if 'async_commands' in self.polyConfig['customParams']:
+            LOGGER.debug('Commands will be sent to the bridges in the background')
+            self.async_commands = True
+        group_batch_window = self._getParam('group_batch_window', 0)
+        if group_batch_window > 0:
+            self.batcher = GroupBatcher(self, group_batch_window)
+        if 'full_poll' in self.polyConfig['customParams']:
+            LOGGER.debug('Bridge state will be polled with a single request')
+            self.full_poll = True
+        self.pool_size = self._getParam('pool_size', self.pool_size)
+        self.pool_idle_timeout = self._getParam('pool_idle_timeout', self.pool_idle_timeout)
+        if 'no_tcp_nodelay' in self.polyConfig['customParams']:
+            self.tcp_nodelay = False
+        self.light_rate = max(0., self._getParam('light_rate', self.light_rate))
+        self.group_rate = max(0., self._getParam('group_rate', self.group_rate))
+        self.json_library = self.polyConfig['customParams'].get('json_library') or None
+        self.poll_workers = max(1, self._getParam('poll_workers', self.poll_workers))
+        self.poll_jitter = self._getParam('poll_jitter', self.poll_jitter)
+        self.poll_executor = ThreadPoolExecutor(max_workers=self.poll_workers)
+        if 'adaptive_poll' in self.polyConfig['customParams']:
+            LOGGER.debug('Bridges will be polled with adaptive per-resource intervals')
+            self.adaptive_poll = True
+            for res in POLL_RESOURCES:
+                self.poll_cadence[res] = (self._getParam('poll_{}_min'.format(res), self.poll_cadence[res][0]),
+                                          self._getParam('poll_{}_max'.format(res), self.poll_cadence[res][1]))
+            self.poll_boost_window = self._getParam('poll_boost_window', self.poll_boost_window)
+        if 'event_stream' in self.polyConfig['customParams']:
+            self.event_stream = self.polyConfig['customParams']['event_stream']
+            self.event_poll_interval = self._getParam('event_poll_interval', self.event_poll_interval)
+            LOGGER.debug('Bridge state changes will be received from the event stream')
+        self.metrics_file = self._getParam('metrics_file', self.metrics_file)
+        self.button_poll = self._getParam('button_poll', self.button_poll)
+        if 0 < self.button_poll < MIN_BUTTON_POLL:
+            LOGGER.warning('button_poll {}s is too short, using {}s'.format(self.button_poll, MIN_BUTTON_POLL))
+            self.button_poll = MIN_BUTTON_POLL
+        ''' Leave half of the bridge command limits to regular commands by default '''
+        self.effects = EffectsEngine(self, self._getParam('effects_rate', self.light_rate / 2), self.group_rate / 2)
         self.connect()
         self.discover()
+        if self.adaptive_poll:
+            self._startScheduler()
 
     def stop(self):
         LOGGER.info('Hue NodeServer is stopping')
+        self.stopping.set()
+        if self.effects is not None:
+            self.effects.stop_all()
+        if self.poll_executor is not None:
+            self.poll_executor.shutdown(wait=False)
+        for dispatcher in self.dispatchers.values():
+            dispatcher.stop()
+        for stream in self.event_streams.values():
+            stream.stop()
+        for poller in self.button_pollers.values():
+            poller.stop()
+        for hub in self.hub.values():
+            if hub is not None:
+                hub.pool.close()
+
+    def longPoll(self):
+        if self.batcher is not None:
+            LOGGER.debug('Group batcher: {}'.format(self.batcher))
+        if self.effects is not None:
+            LOGGER.debug('Effects: {}'.format(self.effects))
+        for idx, hub in self.hub.items():
+            if hub is not None:
+                LOGGER.debug('Hub {} connection pool: {}'.format(idx, hub.pool.stats()))
+                LOGGER.debug('Hub {} command limiter: {}'.format(idx, hub.limiter_stats()))
+            if idx in self.dispatchers:
+                LOGGER.debug('Hub {} command dispatcher: {}'.format(idx, self.dispatchers[idx].stats()))
+            if idx in self.event_streams:
+                LOGGER.debug('Hub {} event stream: {}'.format(idx, self.event_streams[idx]))
+            if idx in self.button_pollers:
+                LOGGER.debug('Hub {} button poller: {}'.format(idx, self.button_pollers[idx]))
+        self._updateMetrics()
+        if self.metrics_file:
+            self._writeMetrics()
+
+    def commandQueueDepth(self):
+        """ Commands waiting in dispatchers, the group batcher and command rate limiters """
+        depth = sum(dispatcher.queue.qsize() for dispatcher in self.dispatchers.values())
+        if self.batcher is not None:
+            depth += sum(len(batch) for batch in list(self.batcher.pending.values()))
+        for hub in self.hub.values():
+            if hub is not None:
+                depth += hub.light_limiter.waiting + hub.group_limiter.waiting
+        return depth
+
+    def _updateMetrics(self):
+        """ Publish poll duration, request latency, error rate and queue depth on the controller node """
+        hubs = [hub for hub in self.hub.values() if hub is not None]
+        latencies = [hub.metrics.latency_percentile(95) for hub in hubs]
+        latencies = [latency for latency in latencies if latency is not None]
+        requests = sum(min(hub.metrics.requests, hub.metrics.window) for hub in hubs)
+        errors = sum(hub.metrics.error_rate() * min(hub.metrics.requests, hub.metrics.window) for hub in hubs)
+        if self.last_poll is not None:
+            self.setDriver('GV1', int(round(self.last_poll * 1000)))
+        if len(latencies) > 0:
+            self.setDriver('GV2', int(round(max(latencies) * 1000)))
+        self.setDriver('GV3', round(100. * errors / requests, 1) if requests > 0 else 0)
+        self.setDriver('GV4', self.commandQueueDepth())
+
+    def _writeMetrics(self):
+        """ Dump all request, poll and command metrics to the metrics file """
+        metrics = {'timestamp': time.time(), 'last_poll': self.last_poll, 'queue_depth': self.commandQueueDepth(),
+                   'hubs': {}}
+        for idx, hub in self.hub.items():
+            if hub is None:
+                continue
+            data = {'requests': hub.metrics.snapshot(), 'pool': hub.pool.stats(), 'limiter': hub.limiter_stats(),
+                    'poll': self.poll_timings.get(idx)}
+            if idx in self.dispatchers:
+                data['dispatcher'] = self.dispatchers[idx].stats()
+            if idx in self.event_streams:
+                stream = self.event_streams[idx]
+                data['event_stream'] = {'connected': stream.connected, 'events': stream.events, 'reconnects': stream.reconnects}
+            metrics['hubs'][idx] = data
+        try:
+            with open(self.metrics_file + '.tmp', 'w') as f:
+                json.dump(metrics, f, indent=2)
+            os.replace(self.metrics_file + '.tmp', self.metrics_file)
+        except (OSError, TypeError, ValueError) as ex:
+            LOGGER.error('Failed to write metrics to {}: {}'.format(self.metrics_file, ex))
+
+    def _getParam(self, name, default):
+        """ Read a numeric custom parameter, falling back to default if missing or invalid """
+        if name not in self.polyConfig['customParams']:
+            return default
+        try:
+            return type(default)(self.polyConfig['customParams'][name])
+        except ValueError:
+            LOGGER.error('Invalid value for {}: {}, using {}'.format(name, self.polyConfig['customParams'][name], default))
+            return default
 
     def shortPoll(self):
-        for idx in self.hub.keys():
-            self.updateNodes(idx)
+        if self.adaptive_poll:
+            if self.scheduler is None or not self.scheduler.is_alive():
+                LOGGER.error('Poll scheduler is not running, restarting')
+                self._startScheduler()
+            return
+        if not self.poll_lock.acquire(blocking=False):
+            LOGGER.warning('Previous poll is still running, skipping this one')
+            return
+        due = {}
+        for idx, hub in self.hub.items():
+            if hub is None:
+                continue
+            resources = ['lights', 'groups'] if self._consistencyDue(idx) else []
+            if self._hasSensors(idx):
+                resources.append('sensors')
+            if len(resources) > 0:
+                due[idx] = resources
+        try:
+            self._pollHubs(due)
+        finally:
+            self.poll_lock.release()
+
+    def _startScheduler(self):
+        self.scheduler = threading.Thread(target=self._scheduleLoop, name='HuePollScheduler', daemon=True)
+        self.scheduler.start()
+
+    def _scheduleLoop(self):
+        """ Poll each hub's resources whenever their cadence is due """
+        while not self.stopping.wait(1):
+            now = time.time()
+            due = {}
+            for hub_idx, hub in list(self.hub.items()):
+                if hub is None:
+                    continue
+                resources = [res for res, cadence in self._hubCadences(hub_idx).items() if cadence.due(now)]
+                if not self._consistencyDue(hub_idx):
+                    resources = [res for res in resources if res not in ['lights', 'groups']]
+                if len(resources) > 0:
+                    due[hub_idx] = resources
+            if len(due) == 0:
+                continue
+            with self.poll_lock:
+                try:
+                    self._pollHubs(due)
+                except Exception as ex:
+                    LOGGER.error(f'Exception during scheduled poll: {ex}')
+
+    def _hubCadences(self, hub_idx):
+        if hub_idx not in self.cadences:
+            self.cadences[hub_idx] = {res: Cadence(self.poll_cadence[res][0], self.poll_cadence[res][1], self.poll_boost_window)
+                                      for res in POLL_RESOURCES}
+        return self.cadences[hub_idx]
+
+    def pollBoost(self, hub_idx, resources=('lights', 'groups')):
+        """ Poll resources at the fastest rate for a while, called when a command is sent """
+        if not self.adaptive_poll:
+            return
+        cadences = self._hubCadences(hub_idx)
+        for res in resources:
+            cadences[res].boost()
+
+    def _consistencyDue(self, hub_idx):
+        """ While the event stream is connected lights and groups are only polled to double check the state """
+        stream = self.event_streams.get(hub_idx)
+        if stream is None or not stream.connected:
+            return True
+        return time.time() - self.consistency_polls.get(hub_idx, 0) >= self.event_poll_interval
+
+    def applyEvents(self, hub_idx, updates):
+        """ Apply (resource, id, state) changes received from the bridge event stream """
+        lights = self.lights.get(hub_idx)
+        groups = self.groups.get(hub_idx)
+        ''' Published data is never changed, changed elements are copied and the copies published '''
+        new_lights = dict(lights) if lights else lights
+        new_groups = dict(groups) if groups else groups
+        changed_lights = set()
+        changed_groups = set()
+        for resource, element_id, state in updates:
+            if resource == 'lights' and lights and element_id in lights:
+                light = dict(new_lights[element_id])
+                light['state'] = dict(light['state'], **state)
+                new_lights[element_id] = light
+                changed_lights.add(element_id)
+            elif resource == 'groups' and groups and element_id in groups:
+                group = dict(new_groups[element_id])
+                group['action'] = dict(group['action'], **{key: val for key, val in state.items() if key != 'reachable'})
+                new_groups[element_id] = group
+                changed_groups.add(element_id)
+        if groups and len(changed_lights) > 0:
+            for group_id, data in groups.items():
+                members = [light_id for light_id in data.get('lights', []) if light_id in new_lights]
+                if changed_lights.isdisjoint(members):
+                    continue
+                on_states = [new_lights[light_id]['state']['on'] for light_id in members]
+                group = dict(new_groups[group_id])
+                group['state'] = {'all_on': len(on_states) > 0 and all(on_states), 'any_on': any(on_states)}
+                new_groups[group_id] = group
+                changed_groups.add(group_id)
+        changes = {}
+        if len(changed_lights) > 0:
+            changes['lights'] = new_lights
+        if len(changed_groups) > 0:
+            changes['groups'] = new_groups
+        if len(changes) > 0:
+            self.hub_data.update(hub_idx, **changes)
+        for node in list(self.hub_nodes.get(hub_idx, {}).values()):
+            if isinstance(node, HueSensor):
+                continue
+            changed = changed_groups if isinstance(node, HueGroup) else changed_lights
+            if str(node.element_id) in changed:
+                node.updateInfo()
+
+    def _pollHubs(self, due):
+        """ Poll hubs in parallel, updating each hub's nodes as soon as its data arrives """
+        poll_start = time.time()
+        if len(due) < 2 or self.poll_executor is None:
+            results = self._inline(due)
+        else:
+            futures = {self.poll_executor.submit(self._fetchHub, idx, random.uniform(0, self.poll_jitter), resources): idx
+                       for idx, resources in due.items()}
+            results = self._completed(futures)
+        for hub_idx, (fetch_time, polled, changed) in results:
+            update_start = time.time()
+            if self.adaptive_poll:
+                cadences = self._hubCadences(hub_idx)
+                for res in polled:
+                    cadences[res].polled(res in changed)
+            if 'lights' in polled or 'groups' in polled:
+                self.consistency_polls[hub_idx] = time.time()
+                self._updateHubNodes(hub_idx)
+            if 'sensors' in polled:
+                self._updateSensorNodes(hub_idx)
+            if 'scenes' in polled and hub_idx in self.scene_stamps:
+                self._refreshScenes(hub_idx, self.scenes.get(hub_idx), self.scene_stamps[hub_idx][1])
+            self.poll_timings[hub_idx] = {'fetch': fetch_time, 'update': time.time() - update_start}
+            LOGGER.debug('Hub {} polled {} in {:.3f}s, changed {}, nodes updated in {:.3f}s'.format(hub_idx, polled, fetch_time, changed, self.poll_timings[hub_idx]['update']))
+        self.last_poll = time.time() - poll_start
+        LOGGER.debug('Poll of {} hubs completed in {:.3f}s'.format(len(due), self.last_poll))
+
+    def _inline(self, due):
+        """ Same results and error handling as _completed, fetching on the calling thread """
+        for hub_idx, resources in due.items():
+            try:
+                yield hub_idx, self._fetchHub(hub_idx, 0, resources)
+            except Exception as ex:
+                LOGGER.error(f'Exception during {hub_idx} poll: {ex}')
+
+    def _completed(self, futures):
+        for future in as_completed(futures):
+            hub_idx = futures[future]
+            try:
+                yield hub_idx, future.result()
+            except Exception as ex:
+                LOGGER.error(f'Exception during {hub_idx} poll: {ex}')
 
     def connect(self):
         custom_data_ip = False
@@ -112,7 +469,10 @@ class Control(polyinterface.Controller):
                 save_needed = True
 
             try:
-                hub_conn = phue.Bridge( hub_ip, hub_user )
+                hub_conn = phue.Bridge( hub_ip, hub_user, pool_size=self.pool_size,
+                                        pool_idle_timeout=self.pool_idle_timeout, tcp_nodelay=self.tcp_nodelay,
+                                        light_rate=self.light_rate, group_rate=self.group_rate,
+                                        json_library=self.json_library, projection=project_response )
             except phue.PhueRegistrationException:
                 LOGGER.error('IP Address OK. Node Server not registered.')
                 self.addNotice({'myNotice': 'Please press the button on the Hue Bridge(s) and restart the node server within 30 seconds'})
@@ -131,6 +491,15 @@ class Control(polyinterface.Controller):
                     self.removeNoticesAll()
                     hub_user = self.hub[hub_ip].username
                     bridges[hub_ip] = hub_user
+                    if self.async_commands:
+                        self.dispatchers[hub_ip] = CommandDispatcher(hub_ip)
+                        self.dispatchers[hub_ip].start()
+                    if self.event_stream is not None:
+                        self.event_streams[hub_ip] = EventStream(self, hub_ip, hub_ip, hub_user, self.event_stream.lower() != 'http')
+                        self.event_streams[hub_ip].start()
+                    if self.button_poll > 0 and hub_ip not in self.button_pollers:
+                        self.button_pollers[hub_ip] = ButtonPoller(self, hub_ip, hub_ip, hub_user, self.button_poll)
+                        self.button_pollers[hub_ip].start()
                 else:
                     LOGGER.error('Connect: Failed to read Lights from the Hue Bridge')
                     self.hub[hub_ip] = None
@@ -145,59 +514,89 @@ class Control(polyinterface.Controller):
                 self.saveCustomData({'bridges': data })
 
     def discover(self, command=None):
-        self.scene_lookup = []
         for idx in self.hub.keys():
-            self._discover(idx)
+            if self.hub[idx] is None:
+                continue
+            threading.Thread(target=self._discover, args=(idx,), name='HueDiscover-{}'.format(idx), daemon=True).start()
 
     def _discover(self, hub_idx):
         """ Poll Hue for new lights/existing lights' statuses """
-        if self.hub[hub_idx] is None or self.discovery == True:
+        if self.hub[hub_idx] is None:
+            return True
+        lock = self.discovery_locks.setdefault(hub_idx, threading.Lock())
+        if not lock.acquire(blocking=False):
+            LOGGER.info('Hub {} discovery is already running'.format(hub_idx))
             return True
-        self.discovery = True
+        try:
+            return self._discoverHub(hub_idx)
+        finally:
+            lock.release()
+
+    def _discoverHub(self, hub_idx):
         LOGGER.info('Hub {} Starting Hue discovery...'.format(hub_idx))
 
-        self.lights[hub_idx] = self._get_lights(hub_idx)
-        if not self.lights[hub_idx]:
+        """ Read everything first, polling and commands keep using the current data meanwhile """
+        lights = self._get_lights(hub_idx)
+        if not lights:
             LOGGER.error('Hub {} Discover: Failed to read Lights from the Hue Bridge'.format(hub_idx))
-            self.discovery = False
             return False
-        
-        LOGGER.info('Hub {} {} bulbs found. Checking status and adding to ISY if necessary.'.format(hub_idx, len(self.lights[hub_idx])))
 
-        for lamp_id, data in self.lights[hub_idx].items():
+        scenes = self._get_scenes(hub_idx)
+        if not scenes:
+            LOGGER.error('Hub {} Discover: Failed to read Scenes from the Hue Bridge'.format(hub_idx))
+
+        groups = self._get_groups(hub_idx)
+        if not groups:
+            LOGGER.error('Hub {} Discover: Failed to read Groups from the Hue Bridge'.format(hub_idx))
+            return False
+
+        sensors = self._get_sensors(hub_idx)
+        if sensors is None:
+            LOGGER.error('Hub {} Discover: Failed to read Sensors from the Hue Bridge'.format(hub_idx))
+
+        snapshot = {'lights': lights, 'groups': groups}
+        if scenes is not None:
+            snapshot['scenes'] = scenes
+        if sensors is not None:
+            snapshot['sensors'] = sensors
+        self.hub_data.update(hub_idx, **snapshot)
+
+        LOGGER.info('Hub {} {} bulbs found. Checking status and adding to ISY if necessary.'.format(hub_idx, len(lights)))
+
+        light_addresses = set()
+        for lamp_id, data in lights.items():
             address = id_2_addr(data['uniqueid'])
             name = data['name']
+            light_addresses.add(address)
             
-            if not address in self.nodes:
+            if address in self.nodes:
+                self._renameNode(hub_idx, address, name)
+            else:
                 if data['type'] == "Extended color light":
                     LOGGER.info('Hub {} Found Extended Color Bulb: {}({})'.format(hub_idx, name, address))
-                    self.addNode(HueEColorLight(self, self.address, address, name, lamp_id, data, hub_idx))
+                    self.addHubNode(HueEColorLight(self, self.address, address, name, lamp_id, data, hub_idx))
                 elif data['type'] == "Color light":
                     LOGGER.info('Hub {} Found Color Bulb: {}({})'.format(hub_idx, name, address))
-                    self.addNode(HueColorLight(self, self.address, address, name, lamp_id, data, hub_idx))
+                    self.addHubNode(HueColorLight(self, self.address, address, name, lamp_id, data, hub_idx))
                 elif data['type'] == "Color temperature light":
                     LOGGER.info('Hub {} Found White Ambiance Bulb: {}({})'.format(hub_idx, name, address))
-                    self.addNode(HueWhiteLight(self, self.address, address, name, lamp_id, data, hub_idx))
+                    self.addHubNode(HueWhiteLight(self, self.address, address, name, lamp_id, data, hub_idx))
                 elif data['type'] == "Dimmable light":
                     LOGGER.info('Hub {} Found Dimmable Bulb: {}({})'.format(hub_idx, name, address))
-                    self.addNode(HueDimmLight(self, self.address, address, name, lamp_id, data, hub_idx))
+                    self.addHubNode(HueDimmLight(self, self.address, address, name, lamp_id, data, hub_idx))
                 else:
                     LOGGER.info('Hub {} Found Unsupported {} Bulb: {}({})'.format(hub_idx, data['type'], name, address))
 
-        self.scenes[hub_idx] = self._get_scenes(hub_idx)
-        if not self.scenes[hub_idx]:
-            LOGGER.error('Hub {} Discover: Failed to read Scenes from the Hue Bridge'.format(hub_idx))
-        
-        self.groups[hub_idx] = self._get_groups(hub_idx)
-        if not self.groups[hub_idx]:
-            LOGGER.error('Hub {} Discover: Failed to read Groups from the Hue Bridge'.format(hub_idx))
-            self.discovery = False
-            return False
+        for address, node in list(self.hub_nodes.get(hub_idx, {}).items()):
+            if isinstance(node, HueDimmLight) and address not in light_addresses:
+                LOGGER.info('Hub {} {}({}) is no longer on the bridge, removing a node'.format(hub_idx, node.name, address))
+                self.delNode(address)
 
-        LOGGER.info('Hub {} {} groups found. Checking status and adding to ISY if necessary.'.format(hub_idx, len(self.groups[hub_idx])))
+        LOGGER.info('Hub {} {} groups found. Checking status and adding to ISY if necessary.'.format(hub_idx, len(groups)))
 
-        for group_id, data in self.groups[hub_idx].items():
-            scene_idx = 0
+        group_scenes = {}
+        group_addresses = set()
+        for group_id, data in groups.items():
             if len(self.hub) > 1:
                 address = 'huegrp'+hub_idx.split('.')[-1]+group_id
             else:
@@ -208,41 +607,244 @@ class Control(polyinterface.Controller):
                 name = data['name']
             
             if 'lights' in data and len(data['lights']) > 0:
-                if not address in self.nodes:
+                group_addresses.add(address)
+                if address in self.nodes:
+                    self._renameNode(hub_idx, address, name)
+                else:
                     LOGGER.info("Hub {} Found {} {} with {} light(s)".format(hub_idx, data['type'], name, len(data['lights'])))
-                    self.addNode(HueGroup(self, self.address, address, name, group_id, data, hub_idx))
-                    if self.scenes[hub_idx]:
-                        for scene_id, scene_data in self.scenes[hub_idx].items():
-                            if 'group' in scene_data:
-                                if scene_data['group'] == group_id:
-                                    self.scene_lookup.append({ "hub": hub_idx, "group": int(group_id), "idx": scene_idx, "id": scene_id, "name": scene_data['name']})
-                                    LOGGER.info(f"Hub {hub_idx} {data['type']} {name} {scene_data['type']} {scene_idx}:{scene_id}:{scene_data['name']}")
-                                    scene_idx += 1
+                    self.addHubNode(HueGroup(self, self.address, address, name, group_id, data, hub_idx))
+                group_scenes[group_id] = "{} {}".format(data['type'], name)
             else:
                 if address in self.nodes:
                     LOGGER.info("Hub {} {} {} does not have any lights in it, removing a node".format(hub_idx, data['type'], name))
                     self.delNode(address)
-        
+
+        for address, node in list(self.hub_nodes.get(hub_idx, {}).items()):
+            if isinstance(node, HueGroup) and address not in group_addresses:
+                LOGGER.info('Hub {} {}({}) is no longer on the bridge, removing a node'.format(hub_idx, node.name, address))
+                self.delNode(address)
+
+        if sensors is None:
+            LOGGER.info('Hub {} keeping sensors from last discovery'.format(hub_idx))
+        else:
+            self._discoverSensors(hub_idx, sensors)
+
+        self._refreshScenes(hub_idx, scenes, group_scenes)
         LOGGER.info('Hub {} Discovery complete'.format(hub_idx))
-        self.discovery = False
         return True
 
+    def _refreshScenes(self, hub_idx, scenes, group_scenes):
+        """ Rebuild scene index of the hub unless its scenes and groups are the same as last time
+
+        The bridge has no way to ask for changed scenes only, the scene list is where
+        the lastupdated stamps come from. So the list is still read every time and
+        only the rebuild of the index is skipped.
+        """
+        scene_stamps = {}
+        if scenes:
+            scene_stamps = {scene_id: scene_data.get('lastupdated') for scene_id, scene_data in scenes.items()}
+        ''' Discovery and the scheduled scenes poll of a hub run on different threads '''
+        with self.scene_locks.setdefault(hub_idx, threading.Lock()):
+            if scenes is None and hub_idx in self.scene_stamps:
+                LOGGER.info('Hub {} keeping scenes from last discovery'.format(hub_idx))
+            elif self.scene_stamps.get(hub_idx) == (scene_stamps, group_scenes):
+                LOGGER.debug('Hub {} scenes have not changed since last index'.format(hub_idx))
+            else:
+                self._indexScenes(hub_idx, scenes, group_scenes)
+                self.scene_stamps[hub_idx] = (scene_stamps, group_scenes)
+
+    def _discoverSensors(self, hub_idx, sensors):
+        LOGGER.info('Hub {} {} sensors found. Checking status and adding to ISY if necessary.'.format(hub_idx, len(sensors)))
+
+        sensor_addresses = set()
+        for sensor_id, data in sensors.items():
+            if 'uniqueid' not in data:
+                ''' Daylight and CLIP sensors are not devices '''
+                continue
+            address = id_2_addr(data['uniqueid'])
+            name = data['name']
+            if data['type'] == "ZLLPresence":
+                node_class = HueMotionSensor
+            elif data['type'] == "ZLLLightLevel":
+                node_class = HueLightLevelSensor
+            elif data['type'] == "ZLLTemperature":
+                node_class = HueTemperatureSensor
+            elif data['type'] in SWITCH_TYPES:
+                node_class = HueSwitch
+            else:
+                continue
+            sensor_addresses.add(address)
+
+            if address in self.nodes:
+                self._renameNode(hub_idx, address, name)
+            else:
+                LOGGER.info('Hub {} Found {} Sensor: {}({})'.format(hub_idx, data['type'], name, address))
+                self.addHubNode(node_class(self, self.address, address, name, sensor_id, data, hub_idx))
+
+        for address, node in list(self.hub_nodes.get(hub_idx, {}).items()):
+            if isinstance(node, HueSensor) and address not in sensor_addresses:
+                LOGGER.info('Hub {} {}({}) is no longer on the bridge, removing a node'.format(hub_idx, node.name, address))
+                self.delNode(address)
+
+    def _renameNode(self, hub_idx, address, name):
+        node = self.nodes[address]
+        if node.name == name:
+            return False
+        LOGGER.info('Hub {} {} was renamed to {}'.format(hub_idx, node.name, name))
+        node.name = name
+        self.addNode(node, update=True)
+        return True
+
+    def _indexScenes(self, hub_idx, scenes, group_names):
+        """ Rebuild scene index of the hub for the given groups, scenes are numbered per group in bridge order """
+        group_scenes = {}
+        if scenes:
+            for scene_id, scene_data in scenes.items():
+                if 'group' in scene_data and scene_data['group'] in group_names:
+                    group_scenes.setdefault(scene_data['group'], []).append((scene_id, scene_data))
+        scene_index = {}
+        for group_id, scenes in group_scenes.items():
+            for scene_idx, (scene_id, scene_data) in enumerate(scenes):
+                scene_index[(int(group_id), scene_idx)] = {"id": scene_id, "name": scene_data['name']}
+                LOGGER.info(f"Hub {hub_idx} {group_names[group_id]} {scene_data['type']} {scene_idx}:{scene_id}:{scene_data['name']}")
+        ''' Swap only this hub's index, in one step so a scene command never sees a partial one '''
+        self.scene_index[hub_idx] = scene_index
+
     def updateNodes(self, hub_idx):
-        if self.hub[hub_idx] is None or self.discovery == True:
+        if self.hub[hub_idx] is None:
             return True
-        self.lights[hub_idx] = self._get_lights(hub_idx)
-        self.groups[hub_idx] = self._get_groups(hub_idx)
+        self._fetchHub(hub_idx)
+        return self._updateHubNodes(hub_idx)
+
+    def _fetchHub(self, hub_idx, delay=0, resources=('lights', 'groups')):
+        """ Read hub state, returns time it took in seconds, resources polled and resources that changed """
+        if delay > 0:
+            time.sleep(delay)
+        fetch_start = time.time()
+        if self.hub[hub_idx] is None:
+            return 0, [], []
+        if self.full_poll:
+            resources = POLL_RESOURCES
+        previous = {res: getattr(self, res).get(hub_idx) for res in resources}
+        if self.full_poll:
+            self._split_api(hub_idx, self._get_api(hub_idx))
+        else:
+            for res in resources:
+                getattr(self, res)[hub_idx] = getattr(self, '_get_' + res)(hub_idx)
+        if 'lights' in resources or 'groups' in resources:
+            ''' Commands completed after this were not included in the state read '''
+            self.fetch_times[hub_idx] = fetch_start
+        changed = [res for res in resources if self._changed(hub_idx, res, previous[res])]
+        return time.time() - fetch_start, list(resources), changed
+
+    def _changed(self, hub_idx, res, previous):
+        """ True if polled data differs from the previous poll, ignoring lights and groups that are fading """
+        current = getattr(self, res).get(hub_idx)
+        if res in ['lights', 'groups'] and current and previous:
+            fading = self._fadingIds(hub_idx, res)
+            if len(fading) > 0:
+                ''' A fade changes state on every poll, it should not keep polling at the fastest rate '''
+                return ({element_id: data for element_id, data in current.items() if element_id not in fading} !=
+                        {element_id: data for element_id, data in previous.items() if element_id not in fading})
+        return current != previous
+
+    def _fadingIds(self, hub_idx, res):
+        """ Ids of the hub's lights or groups with a running transition """
+        node_class = HueGroup if res == 'groups' else HueDimmLight
+        return set(str(node.element_id) for node in list(self.hub_nodes.get(hub_idx, {}).values())
+                   if isinstance(node, node_class) and node.fading())
+
+    def _updateHubNodes(self, hub_idx):
         try:
-            for node in self.nodes:
-                self.nodes[node].updateInfo()
+            for node in list(self.hub_nodes.get(hub_idx, {}).values()):
+                if not isinstance(node, HueSensor):
+                    node.updateInfo()
         except Exception as ex:
             LOGGER.error(f'Exception during {hub_idx} nodes update: {ex}')
             return False
         return True
 
+    def switchNodes(self, hub_idx):
+        """ Switch nodes of a hub by sensor id """
+        return {str(node.element_id): node for node in list(self.hub_nodes.get(hub_idx, {}).values())
+                if isinstance(node, HueSwitch)}
+
+    def _hasSensors(self, hub_idx):
+        return any(isinstance(node, HueSensor) for node in list(self.hub_nodes.get(hub_idx, {}).values()))
+
+    def _updateSensorNodes(self, hub_idx):
+        """ Sensor nodes skip the update themselves unless their state or battery and reachable have changed """
+        try:
+            for node in list(self.hub_nodes.get(hub_idx, {}).values()):
+                if isinstance(node, HueSensor):
+                    node.updateInfo()
+        except Exception as ex:
+            LOGGER.error(f'Exception during {hub_idx} sensors update: {ex}')
+            return False
+        return True
+
+    def hasLightGroups(self, hub_idx):
+        """ True if the hub has a group of more than one light, i.e. light commands could be batched """
+        groups = self.groups.get(hub_idx)
+        if not groups:
+            return False
+        return any(len(data.get('lights', [])) > 1 for data in groups.values())
+
+    def groupCovering(self, hub_idx, light_ids):
+        """ Returns id of a group with exactly the given lights, None if there is no such group """
+        groups = self.groups.get(hub_idx)
+        if not groups:
+            return None
+        for group_id, data in groups.items():
+            if set(data.get('lights', [])) == light_ids:
+                return group_id
+        return None
+
+    def addHubNode(self, node):
+        """ Add a node and index it under the hub it belongs to """
+        self.hub_nodes.setdefault(node.hub_idx, {})[node.address] = node
+        self.addNode(node)
+
+    def delNode(self, address):
+        for nodes in self.hub_nodes.values():
+            nodes.pop(address, None)
+        super().delNode(address)
+
     def updateInfo(self):
         pass
 
+    def _split_api(self, hub_idx, api):
+        """ Distribute full bridge state into lights, groups, scenes and sensors """
+        if not api or 'lights' not in api:
+            self.hub_data.update(hub_idx, lights=None, groups=None)
+            return False
+        groups = api.get('groups', {})
+        groups['0'] = self._all_lights_group(hub_idx, api['lights'])
+        snapshot = {'lights': api['lights'], 'groups': groups}
+        for resource in ('scenes', 'sensors'):
+            if resource in api:
+                snapshot[resource] = api[resource]
+        self.hub_data.update(hub_idx, **snapshot)
+        return True
+
+    def _all_lights_group(self, hub_idx, lights):
+        """ Derive "All Lights" group 0 from the lights instead of fetching /groups/0 """
+        on_states = [light['state']['on'] for light in lights.values()]
+        any_on = any(on_states)
+        previous = self.groups.get(hub_idx)
+        if previous and '0' in previous:
+            action = dict(previous['0']['action'])
+        else:
+            ''' Nothing to carry over yet, seed action from the first light '''
+            action = {}
+            for light in lights.values():
+                action = {key: val for key, val in light['state'].items() if key not in ['reachable', 'mode']}
+                break
+        action['on'] = any_on
+        return {'name': 'Group 0', 'lights': list(lights.keys()), 'type': 'LightGroup',
+                'state': {'all_on': len(on_states) > 0 and all(on_states), 'any_on': any_on},
+                'action': action}
+
     def _get_lights(self, hub_idx):
         if self.hub[hub_idx] is None:
             return None
@@ -283,6 +885,46 @@ class Control(polyinterface.Controller):
             return None
         return groups
 
+    def _get_api(self, hub_idx):
+        if self.hub[hub_idx] is None:
+            return None
+        try:
+            api = self.hub[hub_idx].get_api()
+        except BadStatusLine:
+            LOGGER.error('Hue Bridge returned bad status line.')
+            return None
+        except phue.PhueRequestTimeout:
+            LOGGER.error('Timed out trying to connect to Hue Bridge.')
+            return None
+        except socket.error:
+            LOGGER.error("Can't contact Hue Bridge. " +
+                         "Network communication issue.")
+            return None
+        except Exception as ex:
+            LOGGER.error(f'Hue bridge exception {ex}')
+            return None
+        return api
+
+    def _get_sensors(self, hub_idx):
+        if self.hub[hub_idx] is None:
+            return None
+        try:
+            sensors = self.hub[hub_idx].get_sensor()
+        except BadStatusLine:
+            LOGGER.error('Hue Bridge returned bad status line.')
+            return None
+        except phue.PhueRequestTimeout:
+            LOGGER.error('Timed out trying to connect to Hue Bridge.')
+            return None
+        except socket.error:
+            LOGGER.error("Can't contact Hue Bridge. " +
+                         "Network communication issue.")
+            return None
+        except Exception as ex:
+            LOGGER.error(f'Hue bridge exception {ex}')
+            return None
+        return sensors
+
     def _get_scenes(self, hub_idx):
         if self.hub[hub_idx] is None:
             return None
@@ -303,7 +945,11 @@ class Control(polyinterface.Controller):
             return None
         return scenes
 
-    drivers = [{ 'driver': 'ST', 'value': 1, 'uom': 2 }]
+    drivers = [{ 'driver': 'ST', 'value': 1, 'uom': 2 },
+               { 'driver': 'GV1', 'value': 0, 'uom': 42 },
+               { 'driver': 'GV2', 'value': 0, 'uom': 42 },
+               { 'driver': 'GV3', 'value': 0, 'uom': 51 },
+               { 'driver': 'GV4', 'value': 0, 'uom': 56 }]
     commands = {'DISCOVER': discover}
     id = 'HUEBR'
 
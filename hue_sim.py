@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+""" Local Hue bridge simulator for offline testing and load generation
+
+Implements the v1 REST endpoints used by phue (lights, groups, scenes, sensors,
+config and the /state and /action commands) plus a CLIP v2 style event stream,
+on top of a synthetic topology. Latency, rate limits (901 errors), dropped
+connections and unreachable bulbs can be configured, and the random generator is
+seeded so every run sees the same inputs.
+
+    ./hue_sim.py --port 8080 --ecolor 40 --white 20 --groups 8 --latency 0.05
+
+Then point the node server's `bridges` parameter to `["127.0.0.1:8080"]`, pairing
+always succeeds and returns user `simuser`.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import logging
+import queue
+import random
+import socket
+import threading
+import time
+
+LOGGER = logging.getLogger('hue_sim')
+
+SIM_USER = 'simuser'
+
+""" Light type: (model id, product name, state keys, color gamut) """
+LIGHT_MODELS = {
+    'Dimmable light': ('LWB010', 'Hue white lamp', [], None),
+    'Color temperature light': ('LTW001', 'Hue white ambiance lamp', ['ct'], None),
+    'Color light': ('LST001', 'Hue lightstrip', ['hue', 'sat', 'xy'], 'A'),
+    'Extended color light': ('LCT015', 'Hue color lamp', ['hue', 'sat', 'xy', 'ct'], 'C')
+}
+
+GAMUTS = {
+    'A': [[0.704, 0.296], [0.2151, 0.7106], [0.138, 0.08]],
+    'B': [[0.675, 0.322], [0.409, 0.518], [0.167, 0.04]],
+    'C': [[0.6915, 0.3083], [0.17, 0.7], [0.1532, 0.0475]]
+}
+
+""" Sensor kind: list of (type, model id, state) created for each physical device """
+SENSOR_MODELS = {
+    'dimmer': [('ZLLSwitch', 'RWL021', {'buttonevent': 1002})],
+    'tap': [('ZGPSwitch', 'ZGPSWITCH', {'buttonevent': 34})],
+    'motion': [('ZLLPresence', 'SML001', {'presence': False}),
+               ('ZLLLightLevel', 'SML001', {'lightlevel': 12000, 'dark': False, 'daylight': True}),
+               ('ZLLTemperature', 'SML001', {'temperature': 2100})]
+}
+
+STAMP = '2020-01-01T00:00:00'
+
+
+def timestamp():
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())
+
+
+class SimBridge(object):
+    """ State of a simulated bridge """
+
+    def __init__(self, dimmable=0, white=0, color=0, ecolor=0, groups=0, scenes=0,
+                 dimmers=0, taps=0, motion=0, unreachable=0.0, latency=0.0, jitter=0.0,
+                 light_rate=0, group_rate=0, drop_rate=0.0, seed=0, serial=0):
+        self.random = random.Random(seed)
+        self.serial = serial
+        self.latency = latency
+        self.jitter = jitter
+        self.light_rate = light_rate
+        self.group_rate = group_rate
+        self.drop_rate = drop_rate
+        self.lock = threading.RLock()
+        self.lights = {}
+        self.groups = {}
+        self.scenes = {}
+        self.scene_states = {}
+        self.sensors = {}
+        self.subscribers = []
+        self.stats = {'GET': 0, 'PUT': 0, 'POST': 0, 'dropped': 0, 'throttled': 0, 'events': 0}
+        self.buckets = {'lights': [time.time(), float(light_rate)], 'groups': [time.time(), float(group_rate)]}
+        self.config = {'name': 'Hue Simulator', 'bridgeid': '001788FFFE{:06X}'.format(serial), 'apiversion': '1.50.0',
+                       'swversion': '1950207110', 'modelid': 'BSB002', 'mac': '00:17:88:00:00:{:02x}'.format(serial & 0xff),
+                       'whitelist': {SIM_USER: {'name': 'hue_sim', 'last use date': STAMP, 'create date': STAMP}}}
+        for light_type, count in [('Dimmable light', dimmable), ('Color temperature light', white),
+                                  ('Color light', color), ('Extended color light', ecolor)]:
+            for _ in range(count):
+                self._add_light(light_type, self.random.random() < unreachable)
+        self._add_groups(groups, scenes)
+        for kind, count in [('dimmer', dimmers), ('tap', taps), ('motion', motion)]:
+            for _ in range(count):
+                self._add_sensor(kind)
+
+    def _add_light(self, light_type, unreachable):
+        light_id = str(len(self.lights) + 1)
+        modelid, product, keys, gamut = LIGHT_MODELS[light_type]
+        state = {'on': self.random.random() < 0.5, 'bri': self.random.randint(1, 254)}
+        if 'hue' in keys:
+            state.update({'hue': self.random.randint(0, 65535), 'sat': self.random.randint(0, 254), 'effect': 'none',
+                          'xy': [round(self.random.uniform(0.15, 0.6), 4), round(self.random.uniform(0.1, 0.6), 4)]})
+        if 'ct' in keys:
+            state['ct'] = self.random.randint(153, 500)
+        state['alert'] = 'none'
+        if len(keys) > 0:
+            state['colormode'] = 'xy' if 'xy' in keys else 'ct'
+        state['mode'] = 'homeautomation'
+        state['reachable'] = not unreachable
+        control = {'mindimlevel': 1000, 'maxlumen': 800}
+        if gamut is not None:
+            control['colorgamuttype'] = gamut
+            control['colorgamut'] = GAMUTS[gamut]
+        if 'ct' in keys:
+            control['ct'] = {'min': 153, 'max': 500}
+        self.lights[light_id] = {
+            'state': state,
+            'swupdate': {'state': 'noupdates', 'lastinstall': STAMP},
+            'type': light_type,
+            'name': 'Sim {} {}'.format(product, light_id),
+            'modelid': modelid,
+            'manufacturername': 'Signify Netherlands B.V.',
+            'productname': product,
+            'capabilities': {'certified': True, 'control': control,
+                             'streaming': {'renderer': gamut is not None, 'proxy': gamut is not None}},
+            'config': {'archetype': 'classicbulb', 'function': 'mixed', 'direction': 'omnidirectional'},
+            'uniqueid': '00:17:88:01:{:02x}:{:02x}:{:02x}:{:02x}-0b'.format(
+                self.serial & 0xff, (int(light_id) >> 16) & 0xff, (int(light_id) >> 8) & 0xff, int(light_id) & 0xff),
+            'swversion': '1.50.2_r30933'
+        }
+
+    def _add_groups(self, count, scenes):
+        light_ids = list(self.lights.keys())
+        for idx in range(count):
+            group_id = str(idx + 1)
+            members = light_ids[idx::count]
+            self.groups[group_id] = {'name': 'Sim Room {}'.format(group_id), 'lights': members, 'sensors': [],
+                                     'type': 'Room', 'class': 'Living room', 'recycle': False,
+                                     'action': self._default_action(members)}
+            for scene_idx in range(scenes):
+                scene_id = 'sim{:05d}{:04d}'.format(idx + 1, scene_idx)
+                self.scenes[scene_id] = {'name': 'Sim Scene {}'.format(scene_idx), 'type': 'GroupScene',
+                                         'group': group_id, 'lights': members, 'owner': SIM_USER,
+                                         'recycle': False, 'locked': False, 'appdata': {}, 'picture': '',
+                                         'lastupdated': STAMP, 'version': 2}
+                self.scene_states[scene_id] = {light_id: {'on': True, 'bri': self.random.randint(1, 254)}
+                                               for light_id in members}
+
+    def _default_action(self, members):
+        action = {'on': False, 'bri': 254, 'alert': 'none'}
+        for light_id in members:
+            for key in ['hue', 'sat', 'effect', 'xy', 'ct', 'colormode']:
+                if key in self.lights[light_id]['state'] and key not in action:
+                    action[key] = self.lights[light_id]['state'][key]
+        return action
+
+    def _add_sensor(self, kind):
+        device = len(self.sensors) + 1
+        for sensor_type, modelid, state in SENSOR_MODELS[kind]:
+            sensor_id = str(len(self.sensors) + 1)
+            self.sensors[sensor_id] = {
+                'state': dict(state, lastupdated=STAMP),
+                'config': {'on': True, 'battery': 100, 'reachable': True},
+                'name': 'Sim {} {}'.format(kind, sensor_id),
+                'type': sensor_type,
+                'modelid': modelid,
+                'manufacturername': 'Signify Netherlands B.V.',
+                'swversion': '6.1.1.28573',
+                'uniqueid': '00:17:88:02:{:02x}:{:02x}:{:02x}:{:02x}-02-{:04x}'.format(
+                    self.serial & 0xff, (device >> 16) & 0xff, (device >> 8) & 0xff, device & 0xff, int(sensor_id))
+            }
+
+    def group_state(self, group_id):
+        """ Group with state computed from its lights, the way the bridge reports it """
+        group = dict(self.groups[group_id])
+        on_states = [self.lights[light_id]['state']['on'] for light_id in group['lights']]
+        group['state'] = {'all_on': len(on_states) > 0 and all(on_states), 'any_on': any(on_states)}
+        return group
+
+    def group_zero(self):
+        group = {'name': 'Group 0', 'lights': list(self.lights.keys()), 'sensors': [], 'type': 'LightGroup',
+                 'action': self.groups.get('0', {}).get('action') or self._default_action(list(self.lights.keys()))}
+        self.groups.setdefault('0', {'action': group['action']})
+        on_states = [light['state']['on'] for light in self.lights.values()]
+        group['state'] = {'all_on': len(on_states) > 0 and all(on_states), 'any_on': any(on_states)}
+        return group
+
+    def full_state(self):
+        return {'lights': self.lights,
+                'groups': {group_id: self.group_state(group_id) for group_id in self.groups if group_id != '0'},
+                'scenes': self.scenes, 'sensors': self.sensors, 'config': self.config,
+                'schedules': {}, 'rules': {}, 'resourcelinks': {}}
+
+    def throttled(self, resource):
+        """ Token bucket per resource class, True if the command should be rejected with 901 """
+        rate = self.light_rate if resource == 'lights' else self.group_rate
+        if rate <= 0:
+            return False
+        bucket = self.buckets[resource]
+        now = time.time()
+        bucket[1] = min(rate, bucket[1] + (now - bucket[0]) * rate)
+        bucket[0] = now
+        if bucket[1] < 1:
+            self.stats['throttled'] += 1
+            return True
+        bucket[1] -= 1
+        return False
+
+    def set_state(self, light_id, body, prefix):
+        """ Apply a state body to a light, returns success items """
+        light = self.lights[light_id]
+        state = light['state']
+        result = []
+        for key, val in body.items():
+            if key == 'transitiontime':
+                continue
+            if key == 'bri_inc':
+                state['bri'] = max(1, min(254, state['bri'] + val))
+                result.append({'success': {prefix + '/bri': state['bri']}})
+                continue
+            if key != 'on' and key not in state:
+                result.append({'error': {'type': 6, 'address': prefix + '/' + key,
+                                         'description': 'parameter, {}, not available'.format(key)}})
+                continue
+            if key not in ['on', 'alert'] and not state['on'] and not body.get('on'):
+                result.append({'error': {'type': 201, 'address': prefix + '/' + key,
+                                         'description': 'parameter, {}, is not modifiable. Device is set to off.'.format(key)}})
+                continue
+            state[key] = val
+            if key in ['xy', 'ct', 'hue', 'sat']:
+                state['colormode'] = 'hs' if key in ['hue', 'sat'] else key
+            result.append({'success': {prefix + '/' + key: val}})
+        self.publish(light_id)
+        return result
+
+    def subscribe(self):
+        events = queue.Queue()
+        with self.lock:
+            self.subscribers.append(events)
+        return events
+
+    def unsubscribe(self, events):
+        with self.lock:
+            if events in self.subscribers:
+                self.subscribers.remove(events)
+
+    def publish(self, light_id):
+        if len(self.subscribers) == 0:
+            return
+        state = self.lights[light_id]['state']
+        resource = {'id': 'sim-light-{}'.format(light_id), 'id_v1': '/lights/{}'.format(light_id), 'type': 'light',
+                    'on': {'on': state['on']}, 'dimming': {'brightness': round(state['bri'] / 2.54, 2)}}
+        if 'ct' in state:
+            resource['color_temperature'] = {'mirek': state['ct']}
+        if 'xy' in state:
+            resource['color'] = {'xy': {'x': state['xy'][0], 'y': state['xy'][1]}}
+        event = [{'creationtime': timestamp(), 'id': 'sim-event', 'type': 'update', 'data': [resource]}]
+        self.stats['events'] += 1
+        for events in list(self.subscribers):
+            events.put(event)
+
+    def press(self, sensor_id, buttonevent):
+        """ Simulate a switch button event """
+        with self.lock:
+            self.sensors[sensor_id]['state'] = {'buttonevent': buttonevent, 'lastupdated': timestamp()}
+
+    def sensor_state(self, sensor_id, **state):
+        """ Change a sensor's state, e.g. presence=True """
+        with self.lock:
+            self.sensors[sensor_id]['state'].update(state, lastupdated=timestamp())
+
+
+class SimHandler(BaseHTTPRequestHandler):
+    """ v1 REST API of the simulated bridge """
+
+    protocol_version = 'HTTP/1.1'
+    bridge = None
+
+    def setup(self):
+        super().setup()
+        ''' Headers and body are written separately, do not let Nagle delay the body '''
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, fmt, *args):
+        LOGGER.debug(fmt, *args)
+
+    def _reply(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, error_type, address, description):
+        self._reply([{'error': {'type': error_type, 'address': address, 'description': description}}])
+
+    def _simulate_network(self):
+        """ Apply latency and dropped connections, returns False if the request was dropped """
+        bridge = self.bridge
+        delay = bridge.latency + bridge.random.uniform(0, bridge.jitter) if bridge.jitter else bridge.latency
+        if delay > 0:
+            time.sleep(delay)
+        if bridge.drop_rate > 0 and bridge.random.random() < bridge.drop_rate:
+            bridge.stats['dropped'] += 1
+            self.close_connection = True
+            return False
+        return True
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length == 0:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            return None
+
+    def _route(self):
+        """ Returns (user, path parts after the user) or None if the user is not authorized """
+        parts = [part for part in self.path.split('?')[0].split('/') if part]
+        if len(parts) < 2 or parts[0] != 'api':
+            return None, parts
+        return parts[1], parts[2:]
+
+    def do_GET(self):
+        if self.path.startswith('/eventstream/'):
+            return self._event_stream()
+        body = None
+        with self.bridge.lock:
+            self.bridge.stats['GET'] += 1
+        if not self._simulate_network():
+            return
+        user, parts = self._route()
+        if user != SIM_USER:
+            return self._error(1, '/', 'unauthorized user')
+        bridge = self.bridge
+        with bridge.lock:
+            if len(parts) == 0:
+                body = bridge.full_state()
+            elif parts[0] == 'config':
+                body = bridge.config
+            elif parts[0] in ['lights', 'sensors', 'scenes']:
+                collection = getattr(bridge, parts[0])
+                if len(parts) == 1:
+                    body = collection
+                elif parts[1] in collection:
+                    body = collection[parts[1]]
+            elif parts[0] == 'groups':
+                if len(parts) == 1:
+                    body = {group_id: bridge.group_state(group_id) for group_id in bridge.groups if group_id != '0'}
+                elif parts[1] == '0':
+                    body = bridge.group_zero()
+                elif parts[1] in bridge.groups:
+                    body = bridge.group_state(parts[1])
+            if body is not None:
+                return self._reply(body)
+        return self._error(3, self.path, 'resource, {}, not available'.format(self.path))
+
+    def do_PUT(self):
+        with self.bridge.lock:
+            self.bridge.stats['PUT'] += 1
+        if not self._simulate_network():
+            return
+        user, parts = self._route()
+        data = self._read_body()
+        if user != SIM_USER:
+            return self._error(1, '/', 'unauthorized user')
+        if data is None:
+            return self._error(2, self.path, 'body contains invalid json')
+        bridge = self.bridge
+        with bridge.lock:
+            if len(parts) == 3 and parts[0] == 'lights' and parts[2] == 'state' and parts[1] in bridge.lights:
+                if bridge.throttled('lights'):
+                    return self._error(901, self.path, 'Internal error, 503')
+                if not bridge.lights[parts[1]]['state']['reachable']:
+                    ''' Bridge accepts commands for unreachable lights, they just do not change '''
+                    return self._reply([{'success': {'/lights/{}/state/{}'.format(parts[1], key): val}}
+                                        for key, val in data.items()])
+                return self._reply(bridge.set_state(parts[1], data, '/lights/{}/state'.format(parts[1])))
+            if len(parts) == 3 and parts[0] == 'groups' and parts[2] == 'action' and \
+                    (parts[1] in bridge.groups or parts[1] == '0'):
+                if bridge.throttled('groups'):
+                    return self._error(901, self.path, 'Internal error, 503')
+                return self._reply(self._group_action(parts[1], data))
+            if len(parts) == 2 and parts[0] in ['lights', 'groups', 'sensors'] and parts[1] in getattr(bridge, parts[0]):
+                getattr(bridge, parts[0])[parts[1]].update(data)
+                return self._reply([{'success': {'/{}/{}/{}'.format(parts[0], parts[1], key): val}}
+                                    for key, val in data.items()])
+        return self._error(3, self.path, 'resource, {}, not available'.format(self.path))
+
+    def _group_action(self, group_id, data):
+        bridge = self.bridge
+        members = list(bridge.lights.keys()) if group_id == '0' else bridge.groups[group_id]['lights']
+        prefix = '/groups/{}/action'.format(group_id)
+        if 'scene' in data:
+            scene_id = data['scene']
+            if scene_id not in bridge.scene_states:
+                return [{'error': {'type': 7, 'address': prefix + '/scene',
+                                   'description': 'invalid value, {}, for parameter, scene'.format(scene_id)}}]
+            for light_id, state in bridge.scene_states[scene_id].items():
+                if bridge.lights[light_id]['state']['reachable']:
+                    bridge.set_state(light_id, state, '/lights/{}/state'.format(light_id))
+            return [{'success': {prefix + '/scene': scene_id}}]
+        for light_id in members:
+            if bridge.lights[light_id]['state']['reachable']:
+                body = {key: val for key, val in data.items() if key in ['on', 'bri_inc', 'transitiontime'] or
+                        key in bridge.lights[light_id]['state']}
+                bridge.set_state(light_id, body, '/lights/{}/state'.format(light_id))
+        action = bridge.groups.setdefault(group_id, {'action': {}})['action']
+        for key, val in data.items():
+            if key == 'bri_inc':
+                action['bri'] = max(1, min(254, action.get('bri', 254) + val))
+            elif key != 'transitiontime':
+                action[key] = val
+        return [{'success': {prefix + '/' + key: val}} for key, val in data.items()]
+
+    def do_POST(self):
+        with self.bridge.lock:
+            self.bridge.stats['POST'] += 1
+        if not self._simulate_network():
+            return
+        data = self._read_body()
+        if self.path.rstrip('/') == '/api' and data is not None and 'devicetype' in data:
+            return self._reply([{'success': {'username': SIM_USER}}])
+        return self._error(4, self.path, 'method, POST, not available for resource, {}'.format(self.path))
+
+    def _event_stream(self):
+        """ CLIP v2 style server-sent events, publishes light state changes """
+        if self.headers.get('hue-application-key') != SIM_USER:
+            self.send_response(403)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.close_connection = True
+        events = self.bridge.subscribe()
+        try:
+            self.wfile.write(b': hi\n\n')
+            self.wfile.flush()
+            while True:
+                try:
+                    event = events.get(timeout=10)
+                except queue.Empty:
+                    self.wfile.write(b': hi\n\n')
+                    self.wfile.flush()
+                    continue
+                self.wfile.write('id: {}:0\ndata: {}\n\n'.format(int(time.time()), json.dumps(event)).encode('utf-8'))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.bridge.unsubscribe(events)
+
+
+def start_simulator(host='127.0.0.1', port=0, **options):
+    """ Run a simulated bridge in a background thread, returns (server, bridge)
+
+    Bridge address is '{}:{}'.format(*server.server_address), user is SIM_USER.
+    Stop it with server.shutdown().
+    """
+    bridge = SimBridge(**options)
+    handler = type('BoundSimHandler', (SimHandler,), {'bridge': bridge})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='HueSimulator', daemon=True)
+    thread.start()
+    return server, bridge
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulated Philips Hue bridge')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--dimmable', type=int, default=0, help='number of dimmable lights')
+    parser.add_argument('--white', type=int, default=0, help='number of color temperature lights')
+    parser.add_argument('--color', type=int, default=0, help='number of color lights')
+    parser.add_argument('--ecolor', type=int, default=10, help='number of extended color lights')
+    parser.add_argument('--groups', type=int, default=2, help='number of rooms, lights are spread across them')
+    parser.add_argument('--scenes', type=int, default=3, help='scenes per room')
+    parser.add_argument('--dimmers', type=int, default=0, help='number of dimmer switches')
+    parser.add_argument('--taps', type=int, default=0, help='number of tap switches')
+    parser.add_argument('--motion', type=int, default=0, help='number of motion sensors')
+    parser.add_argument('--unreachable', type=float, default=0.0, help='fraction of unreachable lights')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='maximum random seconds added to latency')
+    parser.add_argument('--light-rate', type=int, default=0, help='light commands per second before 901 errors, 0 is unlimited')
+    parser.add_argument('--group-rate', type=int, default=0, help='group commands per second before 901 errors, 0 is unlimited')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='fraction of requests dropped without a response')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--serial', type=int, default=0, help='bridge serial, use different ones when running several')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    options = vars(args)
+    host, port, debug = options.pop('host'), options.pop('port'), options.pop('debug')
+    server, bridge = start_simulator(host, port, **options)
+    LOGGER.info('Simulated bridge with {} lights, {} groups, {} scenes and {} sensors on {}:{}, user {}'.format(
+        len(bridge.lights), len(bridge.groups), len(bridge.scenes), len(bridge.sensors), host, server.server_address[1], SIM_USER))
+    try:
+        while True:
+            time.sleep(60)
+            LOGGER.info('Requests: {}'.format(bridge.stats))
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,7 +1,11 @@
 """ Node classes used by the Hue Node Server. """
 
-from converters import RGB_2_xy, color_xy, bri2st, kel2mired
+from converters import RGB_2_xy, color_xy, bri2st, kel2mired, clamp_xy, light_gamut, lightlevel2lux
+from effects import EFFECTS
+from buttons import button_command
 import polyinterface
+import threading
+import time
 
 LOGGER = polyinterface.LOGGER
 
@@ -12,18 +16,157 @@ DEF_INCREMENT = 10
 """ Transition time for FadeUp/Down commands """
 FADE_TRANSTIME = 4000
 
+""" Transitions shorter than this (ms) are not tracked, drivers already show their target """
+MIN_TRACKED_TRANSTIME = 1000
+
 HUE_EFFECTS = ['none', 'colorloop']
 HUE_ALERTS = ['none', 'select', 'lselect']
 
-class HueBase(polyinterface.Node):
+""" Color settings that replace each other when commands are merged """
+COLOR_CONFLICTS = {'xy': ['hue', 'sat', 'ct'], 'ct': ['xy', 'hue', 'sat'], 'hue': ['xy', 'ct'], 'sat': ['xy', 'ct']}
+
+def state_fingerprint(*elements):
+    """ Compact summary of bridge state used to detect changes between polls """
+    return hash(repr(elements))
+
+""" Parts of the bridge light and group data the node server reads, the rest is dropped when it arrives """
+LIGHT_FIELDS = ('name', 'type', 'modelid', 'uniqueid')
+GROUP_FIELDS = ('name', 'type')
+STATE_FIELDS = ('on', 'bri', 'ct', 'xy', 'hue', 'sat', 'effect', 'alert', 'reachable', 'colormode')
+GAMUT_FIELDS = ('colorgamut', 'colorgamuttype')
+SENSOR_CONFIG_FIELDS = ('on', 'battery', 'reachable')
+SCENE_FIELDS = ('name', 'type', 'group', 'lastupdated')
+
+def project_light(light):
+    """ Copy of bridge light data with only the fields used by nodes, gamut and discovery """
+    projected = {key: light[key] for key in LIGHT_FIELDS if key in light}
+    state = light.get('state', {})
+    projected['state'] = {key: state[key] for key in STATE_FIELDS if key in state}
+    control = light.get('capabilities', {}).get('control', {})
+    gamut = {key: control[key] for key in GAMUT_FIELDS if key in control}
+    if gamut:
+        projected['capabilities'] = {'control': gamut}
+    return projected
+
+def project_group(group):
+    """ Copy of bridge group data with only the fields used by nodes and discovery """
+    projected = {key: group[key] for key in GROUP_FIELDS if key in group}
+    projected['lights'] = group.get('lights', [])
+    projected['state'] = dict(group.get('state', {}))
+    action = group.get('action', {})
+    projected['action'] = {key: action[key] for key in STATE_FIELDS if key in action}
+    return projected
+
+def project_sensor(sensor):
+    """ Copy of bridge sensor data with only the fields used by sensor nodes and discovery """
+    projected = {key: sensor[key] for key in LIGHT_FIELDS if key in sensor}
+    projected['state'] = sensor.get('state', {})
+    config = sensor.get('config', {})
+    projected['config'] = {key: config[key] for key in SENSOR_CONFIG_FIELDS if key in config}
+    return projected
+
+def project_scene(scene):
+    """ Copy of bridge scene data with only the fields used by the scene index """
+    return {key: scene[key] for key in SCENE_FIELDS if key in scene}
+
+def merge_commands(pending, command):
+    """ Fold a Hue state command into a pending one, so both can be sent as a single request """
+    if command.get('on') is False:
+        """ Nothing but transition time applies to a light that is turned off """
+        merged = {key: val for key, val in pending.items() if key == 'transitiontime'}
+    else:
+        merged = dict(pending)
+    for key, val in command.items():
+        if key == 'bri_inc':
+            if 'bri' in merged:
+                merged['bri'] = min(254, max(1, merged['bri'] + val))
+            else:
+                merged['bri_inc'] = merged.get('bri_inc', 0) + val
+            continue
+        if key == 'bri':
+            merged.pop('bri_inc', None)
+        for conflict in COLOR_CONFLICTS.get(key, []):
+            merged.pop(conflict, None)
+        merged[key] = val
+    return merged
+
+class Transition(object):
+    """ A transition running on the bridge, estimates bri, ct (mired) and xy while it is in progress
+
+    Hue interpolates linearly between the start and target values, so do we.
+    """
+
+    def __init__(self, start, target, duration):
+        self.started = time.time()
+        self.start = start
+        self.target = target
+        self.duration = duration
+        self.timer = None
+
+    def __repr__(self):
+        return '<{0}.{1} target={2} progress={3:.2f}>'.format(
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self.target,
+            self.progress())
+
+    def progress(self, now=None):
+        if now is None:
+            now = time.time()
+        if self.duration <= 0:
+            return 1.
+        return min(1., max(0., (now - self.started) / self.duration))
+
+    def done(self, now=None):
+        return self.progress(now) >= 1.
+
+    def estimate(self, now=None):
+        """ Values the bridge is expected to show right now """
+        progress = self.progress(now)
+        values = {}
+        for key, target in self.target.items():
+            start = self.start.get(key)
+            if start is None:
+                values[key] = target
+            elif key == 'xy':
+                values[key] = [round(begin + (end - begin) * progress, 4) for begin, end in zip(start, target)]
+            else:
+                values[key] = int(round(start + (target - start) * progress))
+        return values
+
+class HueNode(polyinterface.Node):
+    """ Base class for nodes of bridge resources, remembers driver values to skip unchanged updates """
+
+    ''' polyinterface.Node has no slots, so nodes keep an instance dict for its attributes. State added
+        here and in subclasses goes to slots instead, which keeps that dict small with thousands of nodes '''
+    __slots__ = ('driver_cache',)
+
+    def setDriver(self, driver, value, *args, **kwargs):
+        self.driver_cache[driver] = value
+        super().setDriver(driver, value, *args, **kwargs)
+
+    def _updateDriver(self, driver, value):
+        """ Call setDriver only if value differs from the last one set """
+        if driver in self.driver_cache and self.driver_cache[driver] == value:
+            return False
+        self.setDriver(driver, value)
+        return True
+
+class HueBase(HueNode):
     """ Base class for lights and groups """
 
+    __slots__ = ('element_id', 'data', 'gamut', 'on', 'st', 'brightness', 'saved_brightness', 'alert',
+                 'transitiontime', 'ct', 'hue', 'saturation', 'color_x', 'color_y', 'effect', 'hub_idx',
+                 'fingerprint', 'pending_command', 'command_timer', 'command_lock', 'send_lock', 'transition',
+                 'queued', 'command_done')
+
     def __init__(self, controller, primary, address, name, element_id, element, hub_idx):
         super().__init__(controller, primary, address, name)
         self.name = name
         self.address = address
         self.element_id = int(element_id)
         self.data = element
+        self.gamut = light_gamut(element)
         self.on = None
         self.st = None
         self.brightness = None
@@ -37,6 +180,101 @@ class HueBase(polyinterface.Node):
         self.color_y = None
         self.effect = None
         self.hub_idx = hub_idx
+        self.fingerprint = None
+        self.driver_cache = {}
+        self.pending_command = None
+        self.command_timer = None
+        self.command_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.transition = None
+        self.queued = 0
+        self.command_done = 0
+
+    def fading(self):
+        """ True while a tracked transition is still running on the bridge """
+        transition = self.transition
+        return transition is not None and not transition.done()
+
+    def _commandQueued(self):
+        """ A command was handed to the dispatcher or group batcher, drivers show it already """
+        with self.command_lock:
+            self.queued += 1
+
+    def _commandDone(self):
+        with self.command_lock:
+            self.queued -= 1
+            self.command_done = time.time()
+
+    def commandsPending(self):
+        """ True while the drivers show commands that the last polled state does not include """
+        if self.queued > 0 or self.pending_command is not None:
+            return True
+        return self.command_done > self.controller.fetch_times.get(self.hub_idx, 0)
+
+    def _trackTransition(self, command):
+        """ Remember where a command takes bri, ct and xy, so they can be estimated before it completes """
+        previous = self.transition
+        if previous is not None:
+            self.transition = None
+            if previous.timer is not None:
+                previous.timer.cancel()
+        duration = command.get('transitiontime', DEF_TRANSTIME / 100) * 100
+        if duration < MIN_TRACKED_TRANSTIME or command.get('on') is False:
+            return None
+        if previous is not None and not previous.done():
+            start = previous.estimate()
+        else:
+            ''' Last state polled from the bridge, groups keep theirs in action '''
+            state = self.data.get('action', self.data.get('state', {}))
+            start = {key: state[key] for key in ('bri', 'ct', 'xy') if key in state}
+        target = {key: command[key] for key in ('bri', 'ct', 'xy') if key in command}
+        if command.get('bri_inc') and self.brightness is not None:
+            ''' Command handlers have already moved brightness by the increment '''
+            target['bri'] = self.brightness
+            start['bri'] = self.brightness - command['bri_inc']
+        if len(target) == 0:
+            return None
+        transition = Transition(start, target, duration / 1000.)
+        transition.timer = threading.Timer(transition.duration, self._transitionDone, [transition])
+        transition.timer.daemon = True
+        self.transition = transition
+        transition.timer.start()
+        return transition
+
+    def _transitionDone(self, transition):
+        if self.transition is not transition:
+            return
+        self.transition = None
+        self._reportValues(transition.target)
+        ''' Have the next poll confirm the final state '''
+        self.fingerprint = None
+        self.controller.pollBoost(self.hub_idx)
+
+    def _reportValues(self, values):
+        """ Update drivers to estimated bri, ct and xy """
+        if 'bri' in values:
+            self.brightness = values['bri']
+            self.st = bri2st(self.brightness)
+            self._updateDriver('GV5', self.brightness)
+            if self.on:
+                self._updateDriver('ST', self.st)
+        if 'ct' in values:
+            self.ct = kel2mired(values['ct'])
+            self._updateDriver('CLITEMP', self.ct)
+        if 'xy' in values:
+            (self.color_x, self.color_y) = values['xy']
+            self._updateDriver('GV1', self.color_x)
+            self._updateDriver('GV2', self.color_y)
+
+    def _reportCommand(self, command):
+        """ Update drivers to the state a command sent on the node's behalf, e.g. by an effect, sets """
+        if 'on' in command:
+            self.on = command['on']
+        self._reportValues(command)
+        if command.get('on') is False:
+            self._updateDriver('ST', 0)
+        elif command.get('on') and self.st is not None:
+            self._updateDriver('ST', self.st)
 
     """ Basic On/Off and brightness controls """
     def setBaseCtl(self, command):
@@ -84,6 +322,9 @@ class HueBase(polyinterface.Node):
                 """
                 self.saved_brightness = self.brightness
         elif cmd in ['BRT', 'DIM', 'FDUP', 'FDDOWN', 'FDSTOP']:
+            if self.fading():
+                ''' Continue from where the running transition is now, FDSTOP reports it '''
+                self._reportValues(self.transition.estimate())
             if cmd == 'BRT':
                 increment = DEF_INCREMENT
                 if self.brightness + increment > 254:
@@ -102,9 +343,11 @@ class HueBase(polyinterface.Node):
                 """ FDSTOP """
                 increment = 0
             self.brightness += increment
-            self.st = bri2st(self.brightness)
+            if cmd not in ['FDUP', 'FDDOWN']:
+                ''' Fades are reported as they run, see _trackTransition '''
+                self.st = bri2st(self.brightness)
+                self.setDriver('GV5', self.brightness)
             hue_command = { 'bri_inc': increment }
-            self.setDriver('GV5', self.brightness)
             result = self._send_command(hue_command, trans)
         else:
             LOGGER.error('setBaseCtl received an unknown command: {}'.format(cmd))
@@ -121,6 +364,7 @@ class HueBase(polyinterface.Node):
         return self._send_command(hue_command)
 
     def setTransition(self, command):
+        self.fingerprint = None
         self.transitiontime = int(command.get('value'))
         self.setDriver('RR', self.transitiontime)
         return True
@@ -162,7 +406,7 @@ class HueBase(polyinterface.Node):
         color_b = int(query.get('B.uom100'))
         transtime = int(query.get('D.uom42'))
         self.brightness = self._validateBri(int(query.get('BR.uom100')))
-        (self.color_x, self.color_y) = RGB_2_xy(color_r, color_g, color_b)
+        (self.color_x, self.color_y) = clamp_xy(RGB_2_xy(color_r, color_g, color_b), self.gamut)
         hue_command = {'xy': [self.color_x, self.color_y], 'bri': self.brightness}
         self.setDriver('GV1', self.color_x)
         self.setDriver('GV2', self.color_y)
@@ -172,8 +416,7 @@ class HueBase(polyinterface.Node):
 
     def setColorXY(self, command):
         query = command.get('query')
-        self.color_x = float(query.get('X.uom56'))
-        self.color_y = float(query.get('Y.uom56'))
+        (self.color_x, self.color_y) = clamp_xy((float(query.get('X.uom56')), float(query.get('Y.uom56'))), self.gamut)
         transtime = int(query.get('D.uom42'))
         self.brightness = self._validateBri(int(query.get('BR.uom100')))
         hue_command = {'xy': [self.color_x, self.color_y], 'bri': self.brightness}
@@ -185,7 +428,7 @@ class HueBase(polyinterface.Node):
 
     def setColor(self, command):
         c_id = int(command.get('value')) - 1
-        (self.color_x, self.color_y) = color_xy(c_id)
+        (self.color_x, self.color_y) = clamp_xy(color_xy(c_id), self.gamut)
         hue_command = {'xy': [self.color_x, self.color_y]}
         self.setDriver('GV1', self.color_x)
         self.setDriver('GV2', self.color_y)
@@ -222,9 +465,89 @@ class HueBase(polyinterface.Node):
         hue_command = { 'effect': self.effect }
         return self._send_command(hue_command)
 
+    def startEffect(self, command):
+        query = command.get('query')
+        effect = EFFECTS[int(query.get('FX.uom25')) - 1]
+        duration = int(query.get('FXD.uom58', 0))
+        return self.controller.effects.start(self, effect, duration)
+
+    def stopEffect(self, command):
+        return self.controller.effects.stop(self)
+
     def _send_command(self, command, transtime=None, checkOn=True):
         pass
 
+    def _queue_command(self, command):
+        """ Hold command for the coalescing window, merging it with any commands that follow
+
+        Returns True once a command is held, before anything is sent. A held command
+        that fails is reported by _commandFailed, like the dispatcher does.
+        """
+        if self.controller.effects is not None:
+            ''' Any other command takes over from a running effect '''
+            self.controller.effects.stop(self)
+        window = self.controller.coalesce_window
+        if window <= 0 or 'scene' in command:
+            self._flush_commands()
+            return self._dispatch(command)
+        with self.command_lock:
+            if self.pending_command is None:
+                self.pending_command = command
+                self.command_timer = threading.Timer(window / 1000., self._timedFlush)
+                self.command_timer.daemon = True
+                self.command_timer.start()
+            else:
+                self.pending_command = merge_commands(self.pending_command, command)
+        return True
+
+    def _flush_commands(self):
+        with self.command_lock:
+            command = self.pending_command
+            self.pending_command = None
+            if self.command_timer is not None:
+                self.command_timer.cancel()
+                self.command_timer = None
+        if command is None:
+            return True
+        return self._dispatch(command)
+
+    def _timedFlush(self):
+        """ Coalescing timer callback, nobody is waiting for the result so failures are handled here """
+        with self.command_lock:
+            command = self.pending_command
+            self.pending_command = None
+            self.command_timer = None
+        if command is None:
+            return
+        try:
+            sent = self._dispatch(command)
+        except Exception as ex:
+            LOGGER.error('{} failed to send command {}: {}'.format(self.name, command, ex))
+            sent = False
+        if not sent:
+            self._commandFailed(command)
+
+    def _dispatch(self, command):
+        """ Send command to the bridge now, or hand it to the hub's dispatcher if commands are asynchronous """
+        dispatcher = self.controller.dispatchers.get(self.hub_idx)
+        if dispatcher is not None:
+            dispatcher.submit(self, command)
+            return True
+        with self.send_lock:
+            return self._put(command)
+
+    def _put(self, command):
+        pass
+
+    def _commandFailed(self, command):
+        """ Bridge did not accept a dispatched command, re-read the actual state to correct drivers """
+        LOGGER.warning('{} command {} failed, refreshing state'.format(self.name, command))
+        self.fingerprint = None
+        try:
+            self.query()
+        except Exception as ex:
+            LOGGER.error('{} failed to refresh state: {}'.format(self.name, ex))
+
     drivers = []
     commands = {}
     id = ''
@@ -232,6 +555,8 @@ class HueBase(polyinterface.Node):
 class HueDimmLight(HueBase):
     """ Node representing Hue Dimmable Light """
 
+    __slots__ = ('reachable',)
+
     def __init__(self, controller, primary, address, name, element_id, device, hub_idx):
         super().__init__(controller, primary, address, name, element_id, device, hub_idx)
         self.reachable = None
@@ -248,6 +573,7 @@ class HueDimmLight(HueBase):
         if self.data is None:
             return False
         self._updateInfo()
+        self.fingerprint = state_fingerprint(self.data['state'])
         self.reportDrivers()
         
     def updateInfo(self):
@@ -259,7 +585,18 @@ class HueDimmLight(HueBase):
             LOGGER.error('Node {} no longer exists'.format(self.address))
             self.controller.delNode(self.address)
             return False
+        if self.commandsPending():
+            ''' Polled state predates the queued commands, have the poll after them report it '''
+            self.fingerprint = None
+            return True
+        if self.fading():
+            ''' Polled values lag behind a running fade, drivers are updated when it ends '''
+            return True
+        fingerprint = state_fingerprint(self.data['state'])
+        if fingerprint == self.fingerprint:
+            return True
         self._updateInfo()
+        self.fingerprint = fingerprint
 
     def _updateInfo(self):
         if self.on is not None:
@@ -274,23 +611,24 @@ class HueDimmLight(HueBase):
         self.reachable = self.data['state']['reachable']
         self.alert = self.data['state']['alert']
 
-        self.setDriver('GV5', self.brightness)
+        self._updateDriver('GV5', self.brightness)
 
         if self.reachable:
-            self.setDriver('GV6', 1)
+            self._updateDriver('GV6', 1)
         else:
-            self.setDriver('GV6', 0)
+            self._updateDriver('GV6', 0)
 
         if self.on:
-            self.setDriver('ST', self.st)
+            self._updateDriver('ST', self.st)
         else:
-            self.setDriver('ST', 0)
+            self._updateDriver('ST', 0)
 
-        self.setDriver('RR', self.transitiontime)
+        self._updateDriver('RR', self.transitiontime)
         return True
 
     def _send_command(self, command, transtime=None, checkOn=True):
         """ generic method to send command to light """
+        self.fingerprint = None
         if transtime is None:
             transtime = self.transitiontime
         if transtime != DEF_TRANSTIME:
@@ -303,6 +641,19 @@ class HueDimmLight(HueBase):
                 if 'bri' not in command:
                     command['bri'] = self.saved_brightness
                 self.saved_brightness = None
+        self._trackTransition(command)
+        return self._queue_command(command)
+
+    def _dispatch(self, command, batch=True):
+        """ Let the controller collapse identical commands to several lights into a group command """
+        if batch and self.controller.batcher is not None and self.controller.hasLightGroups(self.hub_idx):
+            return self.controller.batcher.submit(self, command)
+        return super()._dispatch(command)
+
+    def _put(self, command):
+        if not self.fading():
+            ''' Fades boost polling once they are over instead '''
+            self.controller.pollBoost(self.hub_idx)
         responses = self.controller.hub[self.hub_idx].set_light(self.element_id, command)
         return all(
             [list(resp.keys())[0] == 'success' for resp in responses[0]])
@@ -318,7 +669,8 @@ class HueDimmLight(HueBase):
                    'DFON': HueBase.setBaseCtl, 'DFOF': HueBase.setBaseCtl, 'BRT': HueBase.setBaseCtl,
                    'DIM': HueBase.setBaseCtl, 'FDUP': HueBase.setBaseCtl, 'FDDOWN': HueBase.setBaseCtl,
                    'FDSTOP': HueBase.setBaseCtl, 'SET_BRI': HueBase.setBrightness, 'RR': HueBase.setTransition,
-                   'SET_ALERT': HueBase.setAlert
+                   'SET_ALERT': HueBase.setAlert,
+                   'FX_START': HueBase.startEffect, 'FX_STOP': HueBase.stopEffect
                }
 
     id = 'DIMM_LIGHT'
@@ -329,7 +681,7 @@ class HueWhiteLight(HueDimmLight):
     def _updateInfo(self):
         super()._updateInfo()
         self.ct = kel2mired(self.data['state']['ct'])
-        self.setDriver('CLITEMP', self.ct)
+        self._updateDriver('CLITEMP', self.ct)
         return True
 
     drivers = [ {'driver': 'ST', 'value': 0, 'uom': 51},
@@ -344,7 +696,8 @@ class HueWhiteLight(HueDimmLight):
                    'DFON': HueBase.setBaseCtl, 'DFOF': HueBase.setBaseCtl, 'BRT': HueBase.setBaseCtl,
                    'DIM': HueBase.setBaseCtl, 'FDUP': HueBase.setBaseCtl, 'FDDOWN': HueBase.setBaseCtl,
                    'FDSTOP': HueBase.setBaseCtl, 'SET_BRI': HueBase.setBrightness, 'RR': HueBase.setTransition,
-                   'CLITEMP': HueBase.setCt, 'SET_ALERT': HueBase.setAlert, 'SET_CTBR': HueBase.setCtBri
+                   'CLITEMP': HueBase.setCt, 'SET_ALERT': HueBase.setAlert, 'SET_CTBR': HueBase.setCtBri,
+                   'FX_START': HueBase.startEffect, 'FX_STOP': HueBase.stopEffect
                }
 
     id = 'WHITE_LIGHT'
@@ -359,10 +712,10 @@ class HueColorLight(HueDimmLight):
                               for val in self.data['state'].get('xy',[0.0,0.0])]
         self.hue = self.data['state']['hue']
         self.saturation = self.data['state']['sat']
-        self.setDriver('GV1', self.color_x)
-        self.setDriver('GV2', self.color_y)
-        self.setDriver('GV3', self.hue)
-        self.setDriver('GV4', self.saturation)
+        self._updateDriver('GV1', self.color_x)
+        self._updateDriver('GV2', self.color_y)
+        self._updateDriver('GV3', self.hue)
+        self._updateDriver('GV4', self.saturation)
         return True
 
     drivers = [ {'driver': 'ST', 'value': 0, 'uom': 51},
@@ -382,7 +735,8 @@ class HueColorLight(HueDimmLight):
                    'FDSTOP': HueBase.setBaseCtl, 'SET_BRI': HueBase.setBrightness, 'RR': HueBase.setTransition,
                    'SET_COLOR': HueBase.setColor, 'SET_HUE': HueBase.setHue, 'SET_SAT': HueBase.setSat, 'SET_HSB': HueBase.setColorHSB,
                    'SET_COLOR_RGB': HueBase.setColorRGB, 'SET_COLOR_XY': HueBase.setColorXY, 'SET_ALERT': HueBase.setAlert,
-                   'SET_EFFECT': HueBase.setEffect
+                   'SET_EFFECT': HueBase.setEffect,
+                   'FX_START': HueBase.startEffect, 'FX_STOP': HueBase.stopEffect
                }
 
     id = 'COLOR_LIGHT'
@@ -393,7 +747,7 @@ class HueEColorLight(HueColorLight):
     def _updateInfo(self):
         super()._updateInfo()
         self.ct = kel2mired(self.data['state']['ct'])
-        self.setDriver('CLITEMP', self.ct)
+        self._updateDriver('CLITEMP', self.ct)
         return True
 
     drivers = [ {'driver': 'ST', 'value': 0, 'uom': 51},
@@ -415,7 +769,8 @@ class HueEColorLight(HueColorLight):
                    'SET_COLOR': HueBase.setColor, 'SET_HUE': HueBase.setHue, 'SET_SAT': HueBase.setSat,
                    'CLITEMP': HueBase.setCt, 'SET_HSB': HueBase.setColorHSB, 'SET_COLOR_RGB': HueBase.setColorRGB,
                    'SET_COLOR_XY': HueBase.setColorXY, 'SET_ALERT': HueBase.setAlert, 'SET_EFFECT': HueBase.setEffect,
-                   'SET_CTBR': HueBase.setCtBri
+                   'SET_CTBR': HueBase.setCtBri,
+                   'FX_START': HueBase.startEffect, 'FX_STOP': HueBase.stopEffect
                }
 
     id = 'ECOLOR_LIGHT'
@@ -423,6 +778,8 @@ class HueEColorLight(HueColorLight):
 class HueGroup(HueBase):
     """ Node representing a group of Hue Lights """
 
+    __slots__ = ('devcount', 'all_on')
+
     def __init__(self, controller, primary, address, name, element_id, device, hub_idx):
         super().__init__(controller, primary, address, name, element_id, device, hub_idx)
         self.devcount = None
@@ -444,13 +801,23 @@ class HueGroup(HueBase):
         except Exception as ex:
             LOGGER.error(f"{self.data['type']} {self.data['name']} exception during update: {ex}")
             return False
+        self.fingerprint = state_fingerprint(self.data['lights'], self.data['state'], self.data['action'])
         self.reportDrivers()
         
     def updateInfo(self):
         if self.controller.groups[self.hub_idx] is None:
             return False
         self.data = self.controller.groups[self.hub_idx][str(self.element_id)]
-        self._updateInfo()
+        if self.commandsPending():
+            self.fingerprint = None
+            return True
+        if self.fading():
+            return True
+        fingerprint = state_fingerprint(self.data['lights'], self.data['state'], self.data['action'])
+        if fingerprint == self.fingerprint:
+            return True
+        if self._updateInfo():
+            self.fingerprint = fingerprint
 
     def _updateInfo(self):
         self.devcount = len(self.data['lights'])
@@ -459,7 +826,7 @@ class HueGroup(HueBase):
             LOGGER.info("{} {} has {} lights, skipping updates".format(self.data['type'], self.data['name'], self.devcount))
             return False
         else:
-            self.setDriver('GV6', self.devcount)
+            self._updateDriver('GV6', self.devcount)
 
         self.on = self.data['state']['any_on']
         if self.all_on != self.data['state']['all_on']:
@@ -471,21 +838,21 @@ class HueGroup(HueBase):
                 self.all_on = False
 
         self.brightness = self.data['action']['bri']
-        self.setDriver('GV5', self.brightness)
+        self._updateDriver('GV5', self.brightness)
 
         self.st = bri2st(self.data['action']['bri'])
         if self.on:
-            self.setDriver('ST', self.st)
+            self._updateDriver('ST', self.st)
         else:
-            self.setDriver('ST', 0)
+            self._updateDriver('ST', 0)
 
         self.alert = self.data['action']['alert']
 
         if 'ct' in self.data['action']:
             self.ct = kel2mired(self.data['action']['ct'])
-            self.setDriver('CLITEMP', self.ct)
+            self._updateDriver('CLITEMP', self.ct)
         else:
-            self.setDriver('CLITEMP', 0)
+            self._updateDriver('CLITEMP', 0)
 
         if 'effect' in self.data['action']:
             self.effect = self.data['action']['effect']
@@ -493,25 +860,25 @@ class HueGroup(HueBase):
         if 'xy' in self.data['action']:
             (self.color_x, self.color_y) = [round(float(val), 4)
                               for val in self.data['action'].get('xy',[0.0,0.0])]
-            self.setDriver('GV1', self.color_x)
-            self.setDriver('GV2', self.color_y)
+            self._updateDriver('GV1', self.color_x)
+            self._updateDriver('GV2', self.color_y)
         else:
-            self.setDriver('GV1', 0)
-            self.setDriver('GV2', 0)
+            self._updateDriver('GV1', 0)
+            self._updateDriver('GV2', 0)
 
         if 'hue' in self.data['action']:
             self.hue = self.data['action']['hue']
-            self.setDriver('GV3', self.hue)
+            self._updateDriver('GV3', self.hue)
         else:
-            self.setDriver('GV3', 0)
+            self._updateDriver('GV3', 0)
 
         if 'sat' in self.data['action']:
             self.saturation = self.data['action']['sat']
-            self.setDriver('GV4', self.saturation)
+            self._updateDriver('GV4', self.saturation)
         else:
-            self.setDriver('GV4', 0)
+            self._updateDriver('GV4', 0)
 
-        self.setDriver('RR', self.transitiontime)
+        self._updateDriver('RR', self.transitiontime)
         return True
 
     def setCt(self, command):
@@ -570,14 +937,15 @@ class HueGroup(HueBase):
 
     def setHueScene(self, command):
         requested_scene_id = int(command.get('value'))
-        for hue_scene in self.controller.scene_lookup:
-            if hue_scene['hub'] == self.hub_idx and hue_scene['group'] == self.element_id and hue_scene['idx'] == requested_scene_id:
-                LOGGER.info(f"{self.data['name']} requested scene: {hue_scene['name']} ({requested_scene_id}), hue scene id: {hue_scene['id']}")
-                return self._send_command({"scene": hue_scene['id']})
+        hue_scene = self.controller.scene_index.get(self.hub_idx, {}).get((self.element_id, requested_scene_id))
+        if hue_scene is not None:
+            LOGGER.info(f"{self.data['name']} requested scene: {hue_scene['name']} ({requested_scene_id}), hue scene id: {hue_scene['id']}")
+            return self._send_command({"scene": hue_scene['id']})
         LOGGER.error(f"{self.data['name']} does not seem to have scene index {requested_scene_id}")
         return False
 
     def _send_command(self, command, transtime=None, checkOn=True):
+        self.fingerprint = None
         if transtime is None:
             transtime = self.transitiontime
         """ generic method to send command to light """
@@ -591,6 +959,13 @@ class HueGroup(HueBase):
                 if 'bri' not in command:
                     command['bri'] = self.saved_brightness
                 self.saved_brightness = None
+        self._trackTransition(command)
+        return self._queue_command(command)
+
+    def _put(self, command):
+        if not self.fading():
+            ''' Fades boost polling once they are over instead '''
+            self.controller.pollBoost(self.hub_idx)
         responses = self.controller.hub[self.hub_idx].set_group(self.element_id, command)
         return all(
             [list(resp.keys())[0] == 'success' for resp in responses[0]])
@@ -614,8 +989,192 @@ class HueGroup(HueBase):
                    'SET_COLOR': setColor, 'SET_HUE': setHue, 'SET_SAT': setSat,
                    'CLITEMP': setCt, 'SET_HSB': setColorHSB, 'SET_COLOR_RGB': setColorRGB,
                    'SET_COLOR_XY': setColorXY, 'SET_ALERT': HueBase.setAlert, 'SET_EFFECT': setEffect,
-                   'SET_CTBR': setCtBri, 'SET_HSCENE': setHueScene
+                   'SET_CTBR': setCtBri, 'SET_HSCENE': setHueScene,
+                   'FX_START': HueBase.startEffect, 'FX_STOP': HueBase.stopEffect
                }
 
     id = 'HUE_GROUP'
 
+
+class HueSensor(HueNode):
+    """ Base class for sensors, state is refreshed from the hub's /sensors poll """
+
+    __slots__ = ('element_id', 'data', 'hub_idx', 'lastupdated', 'change_key')
+
+    def __init__(self, controller, primary, address, name, element_id, element, hub_idx):
+        super().__init__(controller, primary, address, name)
+        self.name = name
+        self.address = address
+        self.element_id = int(element_id)
+        self.data = element
+        self.hub_idx = hub_idx
+        self.lastupdated = None
+        self.change_key = None
+        self.driver_cache = {}
+
+    def start(self):
+        self.updateInfo()
+
+    def query(self, command=None):
+        self.data = self.controller.hub[self.hub_idx].get_sensor(self.element_id)
+        if self.data is None:
+            return False
+        self._updateInfo()
+        self.change_key = self._changeKey()
+        self._stamp(self.data['state'].get('lastupdated'))
+        self.reportDrivers()
+
+    def updateInfo(self):
+        if not self.controller.sensors.get(self.hub_idx):
+            return False
+        try:
+            self.data = self.controller.sensors[self.hub_idx][str(self.element_id)]
+        except KeyError:
+            LOGGER.error('Node {} no longer exists'.format(self.address))
+            self.controller.delNode(self.address)
+            return False
+        change_key = self._changeKey()
+        if change_key == self.change_key:
+            ''' Nothing happened since the last poll '''
+            return True
+        self._updateInfo()
+        self.change_key = change_key
+        self._stamp(change_key[0])
+
+    def _changeKey(self):
+        """ Values whose change needs the drivers updated, config changes do not touch lastupdated """
+        config = self.data.get('config', {})
+        return self.data['state'].get('lastupdated'), config.get('battery'), config.get('reachable')
+
+    def _stamp(self, lastupdated):
+        """ Remember the lastupdated of the state drivers were last updated from """
+        self.lastupdated = lastupdated
+
+    def _updateInfo(self):
+        config = self.data.get('config', {})
+        if 'battery' in config and config['battery'] is not None:
+            self._updateDriver('BATLVL', config['battery'])
+        self._updateDriver('GV6', 1 if config.get('reachable', True) else 0)
+
+    drivers = []
+    commands = {}
+    id = ''
+
+class HueMotionSensor(HueSensor):
+    """ Node representing the presence part of a Hue Motion Sensor """
+
+    __slots__ = ('presence',)
+
+    def __init__(self, controller, primary, address, name, element_id, device, hub_idx):
+        super().__init__(controller, primary, address, name, element_id, device, hub_idx)
+        self.presence = None
+
+    def _updateInfo(self):
+        super()._updateInfo()
+        presence = self.data['state'].get('presence')
+        if presence is None:
+            return
+        if self.presence is not None and presence != self.presence:
+            self.reportCmd('DON' if presence else 'DOF')
+        self.presence = presence
+        self._updateDriver('ST', 1 if presence else 0)
+
+    drivers = [ {'driver': 'ST', 'value': 0, 'uom': 2},
+                {'driver': 'BATLVL', 'value': 0, 'uom': 51},
+                {'driver': 'GV6', 'value': 0, 'uom': 2}
+              ]
+
+    commands = { 'QUERY': HueSensor.query }
+
+    id = 'HUE_MOTION'
+
+class HueLightLevelSensor(HueSensor):
+    """ Node representing the light level part of a Hue Motion Sensor """
+
+    def _updateInfo(self):
+        super()._updateInfo()
+        state = self.data['state']
+        if state.get('lightlevel') is not None:
+            self._updateDriver('ST', lightlevel2lux(state['lightlevel']))
+        if state.get('dark') is not None:
+            self._updateDriver('GV1', 1 if state['dark'] else 0)
+        if state.get('daylight') is not None:
+            self._updateDriver('GV2', 1 if state['daylight'] else 0)
+
+    drivers = [ {'driver': 'ST', 'value': 0, 'uom': 36},
+                {'driver': 'GV1', 'value': 0, 'uom': 2},
+                {'driver': 'GV2', 'value': 0, 'uom': 2},
+                {'driver': 'BATLVL', 'value': 0, 'uom': 51},
+                {'driver': 'GV6', 'value': 0, 'uom': 2}
+              ]
+
+    commands = { 'QUERY': HueSensor.query }
+
+    id = 'HUE_LUX'
+
+class HueTemperatureSensor(HueSensor):
+    """ Node representing the temperature part of a Hue Motion Sensor """
+
+    def _updateInfo(self):
+        super()._updateInfo()
+        temperature = self.data['state'].get('temperature')
+        if temperature is not None:
+            ''' Reported in hundredths of a degree Celsius '''
+            self._updateDriver('ST', round(temperature / 100., 2))
+
+    drivers = [ {'driver': 'ST', 'value': 0, 'uom': 4},
+                {'driver': 'BATLVL', 'value': 0, 'uom': 51},
+                {'driver': 'GV6', 'value': 0, 'uom': 2}
+              ]
+
+    commands = { 'QUERY': HueSensor.query }
+
+    id = 'HUE_TEMP'
+
+class HueSwitch(HueSensor):
+    """ Node representing a Hue Dimmer, Smart Button or Tap switch, button presses are sent as commands """
+
+    __slots__ = ('buttonevent', 'button_lock')
+
+    def __init__(self, controller, primary, address, name, element_id, device, hub_idx):
+        super().__init__(controller, primary, address, name, element_id, device, hub_idx)
+        self.buttonevent = None
+        self.button_lock = threading.Lock()
+
+    def buttonEvent(self, lastupdated, buttonevent):
+        """ Send the command of a new button event, called by regular sensor polls and the button poller """
+        with self.button_lock:
+            if lastupdated == self.lastupdated and buttonevent == self.buttonevent:
+                return False
+            previous = self.buttonevent
+            first = self.lastupdated is None
+            self.lastupdated = lastupdated
+            self.buttonevent = buttonevent
+        if buttonevent is not None:
+            self._updateDriver('GV1', buttonevent)
+        if first:
+            ''' Last event from before the node server started '''
+            return False
+        command = button_command(buttonevent, previous)
+        if command is None:
+            return False
+        LOGGER.debug('{} button event {} sends {}'.format(self.name, buttonevent, command))
+        self.reportCmd(command)
+        return True
+
+    def _stamp(self, lastupdated):
+        """ buttonEvent sets lastupdated under button_lock, together with the event it belongs to """
+        pass
+
+    def _updateInfo(self):
+        super()._updateInfo()
+        self.buttonEvent(self.data['state'].get('lastupdated'), self.data['state'].get('buttonevent'))
+
+    drivers = [ {'driver': 'GV1', 'value': 0, 'uom': 56},
+                {'driver': 'BATLVL', 'value': 0, 'uom': 51},
+                {'driver': 'GV6', 'value': 0, 'uom': 2}
+              ]
+
+    commands = { 'QUERY': HueSensor.query }
+
+    id = 'HUE_SWITCH'
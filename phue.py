@@ -14,11 +14,14 @@ I am in no way affiliated with the Philips organization.
 
 '''
 
+import io
 import json
 import os
 import platform
 import sys
 import socket
+import threading
+import time
 import polyinterface as polyglot
 if sys.version_info[0] > 2:
     PY3K = True
@@ -29,6 +32,14 @@ if PY3K:
     import http.client as httplib
 else:
     import httplib
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 LOGGER = polyglot.LOGGER
 
@@ -64,6 +75,136 @@ class PhueRequestTimeout(PhueException):
     pass
 
 
+""" Bridge error types, see https://developers.meethue.com/develop/hue-api/error-messages/ """
+HUE_ERRORS = {
+    1: 'unauthorized user',
+    2: 'invalid json',
+    3: 'resource not available',
+    4: 'method not available',
+    5: 'missing parameters',
+    6: 'parameter not available',
+    7: 'invalid value',
+    8: 'parameter not modifiable',
+    11: 'too many items in list',
+    12: 'portal connection required',
+    201: 'device is off',
+    901: 'internal error'
+}
+
+""" Errors the bridge reports when it is overloaded, worth retrying """
+RETRY_ERRORS = [901]
+""" Command attributes whose effect adds up when a command is applied twice """
+CUMULATIVE_ATTRIBUTES = ['bri_inc', 'sat_inc', 'hue_inc', 'ct_inc', 'xy_inc', 'alert']
+
+
+def repeatable(mode, data):
+    """ True if sending the request again can not change the result """
+    if mode == 'GET':
+        return True
+    if mode != 'PUT' or not isinstance(data, dict):
+        return False
+    return not any(attribute in data for attribute in CUMULATIVE_ATTRIBUTES)
+
+
+def response_errors(response):
+    """ Returns error types found in a bridge response """
+    errors = []
+    if isinstance(response, list):
+        for item in response:
+            if isinstance(item, dict) and 'error' in item:
+                errors.append(item['error'].get('type'))
+    return errors
+
+
+def _orjson_load(stream):
+    return orjson.loads(stream.read())
+
+
+def _ujson_load(stream):
+    return ujson.loads(stream.read())
+
+
+def _json_load(stream):
+    """ Decode while reading, so the response is not held as bytes and text at the same time """
+    if not PY3K:
+        return json.load(stream)
+    text = io.TextIOWrapper(stream, encoding='utf-8')
+    try:
+        return json.load(text)
+    finally:
+        text.detach()
+
+
+""" JSON libraries responses can be decoded with, fastest first """
+JSON_LIBRARIES = [('orjson', orjson, _orjson_load), ('ujson', ujson, _ujson_load), ('json', json, _json_load)]
+
+
+def json_loader(library=None):
+    """ Returns (name, load) of the JSON library, the fastest one installed if none is given
+
+    load reads and decodes a response stream. Falls back to the standard json module
+    if the requested library is not installed.
+
+    """
+    for name, module, load in JSON_LIBRARIES:
+        if module is not None and (library is None or library == name):
+            return name, load
+    LOGGER.warning('JSON library {} is not installed, using json'.format(library))
+    return 'json', _json_load
+
+
+class TokenBucket(object):
+
+    """ Token bucket limiting the rate of bridge commands
+
+    Each acquire() takes one token and sleeps until it is available. Tokens are
+    reserved in call order, so waiting commands are sent first come, first served.
+    A rate of 0 or less does not limit.
+
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if burst is None:
+            burst = max(1, int(rate))
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.time()
+        self.waiting = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{0}.{1} rate={2} waiting={3} throttled={4}>'.format(
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self.rate,
+            self.waiting,
+            self.throttled)
+
+    def acquire(self):
+        """ Take a token, returns seconds spent waiting for it """
+        if self.rate <= 0:
+            return 0
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            if wait > 0:
+                self.throttled += 1
+                self.waiting += 1
+        if wait > 0:
+            time.sleep(wait)
+            with self._lock:
+                self.waiting -= 1
+        return wait
+
+    def stats(self):
+        with self._lock:
+            return {'rate': self.rate, 'waiting': self.waiting, 'throttled': self.throttled}
+
+
 class Light(object):
 
     """ Hue Light object
@@ -574,6 +715,191 @@ class Scene(object):
             self.lights)
 
 
+class ConnectionPool(object):
+
+    """ Pool of persistent HTTP/1.1 connections to a single bridge
+
+    Idle connections are kept for reuse by later requests, up to `size` of them,
+    and dropped once they have been idle for more than `idle_timeout` seconds.
+
+    """
+    def __init__(self, host, size=2, idle_timeout=30, nodelay=True, timeout=10):
+        self.host = host
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.nodelay = nodelay
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.reconnects = 0
+
+    def __repr__(self):
+        return '<{0}.{1} host="{2}" idle={3} created={4} reused={5} reconnects={6}>'.format(
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self.host,
+            len(self._idle),
+            self.created,
+            self.reused,
+            self.reconnects)
+
+    def _connect(self):
+        connection = httplib.HTTPConnection(self.host, timeout=self.timeout)
+        connection.connect()
+        if self.nodelay:
+            connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self._lock:
+            self.created += 1
+        return connection
+
+    def acquire(self):
+        """ Returns (connection, reused) with an idle connection if one is still fresh """
+        now = time.time()
+        stale = []
+        connection = None
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used > self.idle_timeout:
+                    stale.append(conn)
+                    continue
+                connection = conn
+                self.reused += 1
+                break
+        for conn in stale:
+            conn.close()
+        if connection is not None:
+            return connection, True
+        return self._connect(), False
+
+    def release(self, connection, reusable=True):
+        """ Return a connection to the pool, closing it if it can not be kept """
+        if reusable:
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append((connection, time.time()))
+                    return
+        connection.close()
+
+    def discard(self, connection, reconnect=False):
+        """ Close a broken connection """
+        connection.close()
+        if reconnect:
+            with self._lock:
+                self.reconnects += 1
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for conn, last_used in idle:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {'idle': len(self._idle), 'created': self.created,
+                    'reused': self.reused, 'reconnects': self.reconnects}
+
+
+""" Upper bounds in seconds of the request latency histogram buckets, the last bucket is unbounded """
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+def request_endpoint(address):
+    """ Endpoint of a request address with username and resource ids left out, e.g. lights/<id>/state """
+    parts = [part for part in address.split('?')[0].split('/') if part]
+    if len(parts) > 0 and parts[0] == 'api':
+        parts = parts[2:]
+    if len(parts) == 0:
+        return 'api'
+    if len(parts) > 1:
+        parts[1] = '<id>'
+    return '/'.join(parts)
+
+
+class RequestMetrics(object):
+
+    """ Request counters, error counts and latency histograms of a bridge
+
+    Counts are kept per endpoint and method. Bridge errors are counted by Hue error
+    type, failed requests by the kind of failure. The latencies and outcomes of the
+    last `window` requests are kept to report recent percentiles and error rate.
+
+    """
+    def __init__(self, window=500):
+        self.endpoints = {}
+        self.errors = {}
+        self.requests = 0
+        self.failed = 0
+        self.recent = []
+        self.window = window
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{0}.{1} requests={2} failed={3} p95={4} error_rate={5:.3f}>'.format(
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self.requests,
+            self.failed,
+            self.latency_percentile(95),
+            self.error_rate())
+
+    def record(self, mode, address, seconds, errors=None, failure=None):
+        """ Count a request, errors are Hue error types of the response, failure names what went wrong """
+        key = '{} {}'.format(mode, request_endpoint(address))
+        bucket = len(LATENCY_BUCKETS)
+        for idx, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                bucket = idx
+                break
+        failed = failure is not None or bool(errors)
+        with self._lock:
+            entry = self.endpoints.get(key)
+            if entry is None:
+                entry = {'count': 0, 'errors': 0, 'seconds': 0.0, 'histogram': [0] * (len(LATENCY_BUCKETS) + 1)}
+                self.endpoints[key] = entry
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['histogram'][bucket] += 1
+            self.requests += 1
+            if failed:
+                entry['errors'] += 1
+                self.failed += 1
+            for error in ([failure] if failure is not None else []) + list(errors or []):
+                self.errors[error] = self.errors.get(error, 0) + 1
+            self.recent.append((seconds, failed))
+            if len(self.recent) > self.window:
+                del self.recent[:len(self.recent) - self.window]
+
+    def latency_percentile(self, pct):
+        """ Latency in seconds of recent requests at the given percentile, None if there were none """
+        with self._lock:
+            latencies = sorted(seconds for seconds, failed in self.recent)
+        if len(latencies) == 0:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * pct / 100.))]
+
+    def error_rate(self):
+        """ Fraction of recent requests that failed or returned an error """
+        with self._lock:
+            if len(self.recent) == 0:
+                return 0.0
+            return sum(1 for seconds, failed in self.recent if failed) / float(len(self.recent))
+
+    def snapshot(self):
+        with self._lock:
+            endpoints = {key: dict(entry, histogram=list(entry['histogram'])) for key, entry in self.endpoints.items()}
+            data = {'requests': self.requests, 'failed': self.failed,
+                    'errors': {str(error): count for error, count in self.errors.items()},
+                    'buckets': LATENCY_BUCKETS, 'endpoints': endpoints}
+        data['p50'] = self.latency_percentile(50)
+        data['p95'] = self.latency_percentile(95)
+        data['error_rate'] = self.error_rate()
+        return data
+
+
 class Bridge(object):
 
     """ Interface to the Hue ZigBee bridge
@@ -595,7 +921,10 @@ class Bridge(object):
 
 
     """
-    def __init__(self, ip=None, username=None, config_file_path=None):
+    def __init__(self, ip=None, username=None, config_file_path=None,
+                 pool_size=2, pool_idle_timeout=30, tcp_nodelay=True,
+                 light_rate=10, group_rate=1, max_retries=3, retry_delay=0.5,
+                 json_library=None, projection=None):
         """ Initialization function.
 
         Parameters:
@@ -603,6 +932,26 @@ class Bridge(object):
         ip : string
             IP address as dotted quad
         username : string, optional
+        pool_size : int, optional
+            Number of idle keep-alive connections kept open to the bridge
+        pool_idle_timeout : int, optional
+            Seconds an idle connection is kept before it is discarded
+        tcp_nodelay : bool, optional
+            Disable Nagle's algorithm on bridge connections
+        light_rate : float, optional
+            Light commands per second sent to the bridge, 0 for no limit
+        group_rate : float, optional
+            Group commands per second sent to the bridge, 0 for no limit
+        max_retries : int, optional
+            Retries of a command rejected with an overload (901) error, or of a
+            timed out command that is safe to repeat
+        retry_delay : float, optional
+            Seconds before the first retry, doubled on each following one
+        json_library : string, optional
+            orjson, ujson or json, the fastest one installed by default
+        projection : callable, optional
+            projection(address, response) applied to GET responses, to
+            keep only the parts of them that are used
 
         """
 
@@ -622,6 +971,20 @@ class Bridge(object):
         self.sensors_by_id = {}
         self.sensors_by_name = {}
         self._name = None
+        self.pool_size = pool_size
+        self.pool_idle_timeout = pool_idle_timeout
+        self.tcp_nodelay = tcp_nodelay
+        self._pool = None
+        self.light_limiter = TokenBucket(light_rate)
+        self.group_limiter = TokenBucket(group_rate)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.retries = 0
+        self.errors = {}
+        self._stats_lock = threading.Lock()
+        self.metrics = RequestMetrics()
+        self.json_library, self._json_load = json_loader(json_library)
+        self.projection = projection
 
         # self.minutes = 600 # these do not seem to be used anywhere?
         # self.seconds = 10
@@ -642,32 +1005,116 @@ class Bridge(object):
         self.request(
             'PUT', '/api/' + self.username + '/config', data)
 
+    @property
+    def pool(self):
+        """ Keep-alive connection pool for the current bridge ip """
+        if self._pool is None or self._pool.host != self.ip:
+            if self._pool is not None:
+                self._pool.close()
+            self._pool = ConnectionPool(self.ip, self.pool_size, self.pool_idle_timeout, self.tcp_nodelay)
+        return self._pool
+
     def request(self, mode='GET', address=None, data=None):
         """ Utility function for HTTP GET/PUT requests for the API"""
-        connection = httplib.HTTPConnection(self.ip, timeout=10)
+        pool = self.pool
+        body = None
+        if mode == 'PUT' or mode == 'POST':
+            body = json.dumps(data)
 
-        try:
-            if mode == 'GET' or mode == 'DELETE':
-                connection.request(mode, address)
-            if mode == 'PUT' or mode == 'POST':
-                connection.request(mode, address, json.dumps(data))
-
-            LOGGER.debug("{0} {1} {2}".format(mode, address, str(data)))
+        start = time.time()
+        while True:
+            try:
+                connection, reused = pool.acquire()
+            except socket.timeout:
+                self.metrics.record(mode, address, time.time() - start, failure='connection')
+                error = "{} Connection to {} timed out.".format(mode, self.ip)
+                LOGGER.error(error)
+                raise PhueRequestTimeout(None, error)
+            except socket.error:
+                ''' Bridge is down or unreachable '''
+                self.metrics.record(mode, address, time.time() - start, failure='connection')
+                raise
+            invalid = None
+            sent = False
+            try:
+                connection.request(mode, address, body)
+                sent = True
+                LOGGER.debug("{0} {1} {2}".format(mode, address, str(data)))
+                result = connection.getresponse()
+                try:
+                    decoded = self._json_load(result)
+                except ValueError as ex:
+                    invalid = ex
+            except socket.timeout:
+                pool.discard(connection)
+                self.metrics.record(mode, address, time.time() - start, failure='timeout')
+                error = "{} Request to {}{} timed out.".format(mode, self.ip, address)
+
+                LOGGER.exception(error)
+                raise PhueRequestTimeout(None, error)
+            except (httplib.BadStatusLine, socket.error):
+                """
+                Bridge closed an idle connection, retry once on a fresh one. A command that
+                was already sent may have been applied, it is not sent again.
+                """
+                pool.discard(connection, reused)
+                if reused and (not sent or mode == 'GET'):
+                    continue
+                self.metrics.record(mode, address, time.time() - start, failure='connection')
+                raise
+            except httplib.HTTPException:
+                pool.discard(connection)
+                self.metrics.record(mode, address, time.time() - start, failure='connection')
+                raise
+            ''' Body may not have been read to the end if it was not valid JSON '''
+            pool.release(connection, invalid is None and not result.will_close)
+            break
 
-        except socket.timeout:
-            error = "{} Request to {}{} timed out.".format(mode, self.ip, address)
+        if invalid is not None:
+            self.metrics.record(mode, address, time.time() - start, failure='invalid response')
+            raise invalid
+        self.metrics.record(mode, address, time.time() - start, errors=response_errors(decoded))
+        if self.projection is not None and mode == 'GET':
+            decoded = self.projection(address, decoded)
+        return decoded
 
-            LOGGER.exception(error)
-            raise PhueRequestTimeout(None, error)
+    def limited_request(self, limiter, mode, address, data=None):
+        """ Send a rate limited command, retrying bridge overload errors with backoff
 
-        result = connection.getresponse()
-        response = result.read()
-        connection.close()
-        if PY3K:
-            return json.loads(response.decode('utf-8'))
-        else:
-            LOGGER.debug(response)
-            return json.loads(response)
+        A command that timed out may still have been applied, it is only sent again
+        if applying it twice has the same result as applying it once.
+        """
+        delay = self.retry_delay
+        attempt = 0
+        while True:
+            limiter.acquire()
+            try:
+                response = self.request(mode, address, data)
+            except PhueRequestTimeout:
+                if attempt >= self.max_retries or not repeatable(mode, data):
+                    raise
+                reason = 'timeout'
+            else:
+                errors = response_errors(response)
+                with self._stats_lock:
+                    for error_type in errors:
+                        self.errors[error_type] = self.errors.get(error_type, 0) + 1
+                retry = [error_type for error_type in errors if error_type in RETRY_ERRORS]
+                if len(retry) == 0 or attempt >= self.max_retries:
+                    return response
+                reason = HUE_ERRORS[retry[0]]
+            attempt += 1
+            with self._stats_lock:
+                self.retries += 1
+            LOGGER.warning("{0} {1} failed: {2}, retry {3} in {4}s".format(mode, address, reason, attempt, delay))
+            time.sleep(delay)
+            delay *= 2
+
+    def limiter_stats(self):
+        """ Command queue depth, throttle and error counters """
+        with self._stats_lock:
+            return {'light': self.light_limiter.stats(), 'group': self.group_limiter.stats(),
+                    'retries': self.retries, 'errors': dict(self.errors)}
 
     def get_ip_address(self, set_result=False):
 
@@ -897,7 +1344,7 @@ class Bridge(object):
                     converted_light = self.get_light_id_by_name(light)
                 else:
                     converted_light = light
-                result.append(self.request('PUT', '/api/' + self.username + '/lights/' + str(
+                result.append(self.limited_request(self.light_limiter, 'PUT', '/api/' + self.username + '/lights/' + str(
                     converted_light) + '/state', data))
 
             if len(result) > 0 and len(result[-1]) > 0:
@@ -1113,7 +1560,7 @@ class Bridge(object):
             if parameter == 'name' or parameter == 'lights':
                 result.append(self.request('PUT', '/api/' + self.username + '/groups/' + str(converted_group), data))
             else:
-                result.append(self.request('PUT', '/api/' + self.username + '/groups/' + str(converted_group) + '/action', data))
+                result.append(self.limited_request(self.group_limiter, 'PUT', '/api/' + self.username + '/groups/' + str(converted_group) + '/action', data))
 
         if len(result) > 0 and len(result[-1]) > 0:
             if 'error' in list(result[-1][0].keys()):
@@ -0,0 +1,70 @@
+""" Adaptive polling cadences used by the Hue Node Server. """
+
+import threading
+import time
+
+""" Resource classes polled from the bridge """
+POLL_RESOURCES = ['lights', 'groups', 'scenes', 'sensors']
+
+""" Default (min, max) polling intervals in seconds per resource class """
+DEF_CADENCE = {
+    'lights': (2, 30),
+    'groups': (2, 30),
+    'scenes': (60, 900),
+    'sensors': (2, 30)
+}
+
+""" Seconds to keep polling at the minimum interval after a command or a change """
+DEF_BOOST_WINDOW = 30
+
+
+class Cadence(object):
+    """ Polling interval for one resource class of a hub
+
+    Polls at min_interval for boost_window seconds after a command or a detected
+    change, then doubles the interval on each quiet poll up to max_interval.
+    Commands boost it from their own threads while the poll updates it.
+    """
+
+    def __init__(self, min_interval, max_interval, boost_window=DEF_BOOST_WINDOW):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.boost_window = boost_window
+        self.interval = min_interval
+        self.next_due = 0
+        self.boost_until = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{0}.{1} interval={2} next_due={3:.1f}>'.format(
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self.interval,
+            self.next_due - time.time())
+
+    def due(self, now=None):
+        if now is None:
+            now = time.time()
+        return now >= self.next_due
+
+    def boost(self, now=None):
+        """ Switch to the minimum interval, e.g. after a command was sent """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.boost_until = now + self.boost_window
+            self.interval = self.min_interval
+            self.next_due = min(self.next_due, now + self.min_interval)
+
+    def polled(self, changed, now=None):
+        """ Schedule the next poll, backing off while nothing changes """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if changed:
+                self.boost_until = now + self.boost_window
+            if now < self.boost_until:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * 2, self.max_interval)
+            self.next_due = now + self.interval
@@ -0,0 +1,464 @@
+""" Tests of the Hue Node Server against simulated bridges, run with pytest """
+
+import itertools
+import socket
+import threading
+import time
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+import pytest
+
+import converters
+import effects
+import hue
+import hue_sim
+import phue
+from buttons import button_command
+from conftest import StubNode, discovery_idle, wait_for
+from node_types import merge_commands
+
+
+def test_button_command():
+    assert button_command(None) is None
+    assert button_command(1000) == 'DON'
+    assert button_command(4000) == 'DOF'
+    assert button_command(2001) == 'BRT'
+    assert button_command(3001) == 'DIM'
+    ''' Holding on or off does not repeat '''
+    assert button_command(1001) is None
+    assert button_command(1002, 1000) is None
+    assert button_command(1002, 4002) == 'DON'
+    assert button_command(1003) is None
+    assert button_command(5000) is None
+    assert button_command(34) == 'DON'
+    assert button_command(16) == 'BRT'
+    assert button_command(17) == 'DIM'
+    assert button_command(18) == 'DOF'
+
+
+def test_merge_commands():
+    assert merge_commands({'bri': 100}, {'bri_inc': 20}) == {'bri': 120}
+    assert merge_commands({'bri': 250}, {'bri_inc': 20}) == {'bri': 254}
+    assert merge_commands({'bri_inc': 10}, {'bri_inc': -30}) == {'bri_inc': -20}
+    assert merge_commands({'bri_inc': 10}, {'bri': 50}) == {'bri': 50}
+    assert merge_commands({'on': True, 'bri': 100, 'transitiontime': 4}, {'on': False}) == \
+        {'transitiontime': 4, 'on': False}
+    assert merge_commands({'ct': 300, 'bri': 10}, {'xy': [0.3, 0.3]}) == {'bri': 10, 'xy': [0.3, 0.3]}
+    assert merge_commands({'xy': [0.3, 0.3]}, {'hue': 100, 'sat': 200}) == {'hue': 100, 'sat': 200}
+
+
+def test_token_bucket_timing():
+    bucket = phue.TokenBucket(20, burst=2)
+    start = time.time()
+    waits = [bucket.acquire() for _ in range(6)]
+    elapsed = time.time() - start
+    assert waits[:2] == [0, 0]
+    assert all(wait > 0 for wait in waits[2:])
+    ''' Four tokens beyond the burst at 20 per second '''
+    assert 0.15 <= elapsed < 0.5
+    assert bucket.stats()['throttled'] == 4
+
+
+def test_token_bucket_zero_rate_is_unlimited():
+    bucket = phue.TokenBucket(0)
+    start = time.time()
+    assert all(bucket.acquire() == 0 for _ in range(100))
+    assert time.time() - start < 0.1
+
+
+def test_converter_tables_match_reference():
+    for bri in range(255):
+        assert converters.bri2st(bri) == converters._bri2st(bri)
+    for value in range(0, 6501):
+        assert converters.kel2mired(value) == converters._kel2mired(value)
+    for rgb in itertools.product(range(0, 256, 15), repeat=3):
+        assert converters.RGB_2_xy(*rgb) == converters._RGB_2_xy(*rgb)
+    for c_id, color in converters.colors.items():
+        assert converters.color_xy(c_id) == converters._RGB_2_xy(*color[1])
+
+
+class FailingConnection(object):
+    """ Connection that fails in request (before sending) or in getresponse (after sending) """
+
+    def __init__(self, fail_in, error):
+        self.fail_in = fail_in
+        self.error = error
+        self.sent = 0
+        self.closed = False
+
+    def request(self, mode, address, body=None):
+        if self.fail_in == 'request':
+            raise self.error
+        self.sent += 1
+
+    def getresponse(self):
+        raise self.error
+
+    def close(self):
+        self.closed = True
+
+
+class ScriptedPool(phue.ConnectionPool):
+    """ Hands out the given connections as reused ones first, then real connections """
+
+    def __init__(self, host, connections):
+        super().__init__(host)
+        self.connections = list(connections)
+
+    def acquire(self):
+        if self.connections:
+            return self.connections.pop(0), True
+        return super().acquire()
+
+
+def bridge_with(address, connections, **options):
+    bridge = phue.Bridge(address, hue_sim.SIM_USER, **options)
+    bridge._pool = ScriptedPool(address, connections)
+    return bridge
+
+
+def test_request_retries_get_on_closed_connection(simulator):
+    address, sim = simulator(dimmable=1)
+    stale = FailingConnection('getresponse', httplib.RemoteDisconnected('closed'))
+    bridge = bridge_with(address, [stale])
+    assert '1' in bridge.request('GET', '/api/{}/lights'.format(hue_sim.SIM_USER))
+    assert stale.closed
+    assert sim.stats['GET'] == 1
+
+
+def test_request_does_not_resend_command_that_was_sent(simulator):
+    address, sim = simulator(dimmable=1)
+    stale = FailingConnection('getresponse', httplib.RemoteDisconnected('closed'))
+    bridge = bridge_with(address, [stale])
+    with pytest.raises(httplib.RemoteDisconnected):
+        bridge.request('PUT', '/api/{}/lights/1/state'.format(hue_sim.SIM_USER), {'bri_inc': 10})
+    assert stale.sent == 1
+    assert sim.stats['PUT'] == 0
+
+
+def test_request_resends_command_that_was_not_sent(simulator):
+    address, sim = simulator(dimmable=1)
+    stale = FailingConnection('request', BrokenPipeError())
+    bridge = bridge_with(address, [stale])
+    bridge.request('PUT', '/api/{}/lights/1/state'.format(hue_sim.SIM_USER), {'on': True})
+    assert stale.closed
+    assert sim.stats['PUT'] == 1
+
+
+def test_request_discards_connection_on_other_http_errors(simulator):
+    address, sim = simulator(dimmable=1)
+    broken = FailingConnection('getresponse', httplib.IncompleteRead(b''))
+    bridge = bridge_with(address, [broken])
+    with pytest.raises(httplib.IncompleteRead):
+        bridge.request('GET', '/api/{}/lights'.format(hue_sim.SIM_USER))
+    assert broken.closed
+    assert bridge.pool.stats()['idle'] == 0
+
+
+def test_limited_request_retries_overload(simulator):
+    address, sim = simulator(dimmable=1, light_rate=5)
+    bridge = phue.Bridge(address, hue_sim.SIM_USER, light_rate=0, retry_delay=0.25)
+    for _ in range(6):
+        response = bridge.set_light(1, {'on': True})
+    assert list(response[0][0].keys())[0] == 'success'
+    assert sim.stats['throttled'] >= 1
+    assert bridge.retries == sim.stats['throttled']
+    assert bridge.errors[901] == sim.stats['throttled']
+
+
+@pytest.mark.parametrize('command, attempts', [({'on': True}, 3), ({'bri': 10}, 3), ({'bri_inc': 10}, 1),
+                                               ({'ct_inc': 10, 'on': True}, 1), ({'alert': 'select'}, 1)])
+def test_limited_request_repeats_only_absolute_commands_on_timeout(simulator, command, attempts):
+    address, sim = simulator(dimmable=1)
+    bridge = phue.Bridge(address, hue_sim.SIM_USER, light_rate=0, max_retries=2, retry_delay=0.01)
+    sent = []
+
+    def timeout(mode, address, data=None):
+        sent.append(data)
+        raise phue.PhueRequestTimeout(None, 'timed out')
+    bridge.request = timeout
+    with pytest.raises(phue.PhueRequestTimeout):
+        bridge.set_light(1, command)
+    assert len(sent) == attempts
+
+
+def group_threads(controller, address):
+    """ Names of the threads the hub's group commands are sent from """
+    threads = []
+    hub = controller.hub[address]
+    set_group = hub.set_group
+
+    def record(*args, **kwargs):
+        threads.append(threading.current_thread().name)
+        return set_group(*args, **kwargs)
+    hub.set_group = record
+    return threads
+
+
+@pytest.mark.parametrize('params, thread', [({}, 'Thread-'), ({'async_commands': 1}, 'HueDispatch-')])
+def test_group_batcher_collapses_light_commands(simulator, control, params, thread):
+    address, sim = simulator(dimmable=4, groups=1)
+    controller = control(address, group_batch_window=50, **params)
+    threads = group_threads(controller, address)
+    lights = [node for node in controller.nodes.values() if isinstance(node, hue.HueDimmLight)]
+    assert len(lights) == 4
+    puts = sim.stats['PUT']
+    for node in lights:
+        node.setBaseCtl({'cmd': 'DOF'})
+    wait_for(lambda: len(threads) == 1 and sim.stats['PUT'] > puts, 5)
+    time.sleep(0.1)
+    assert controller.batcher.collapsed == 1
+    assert sim.stats['PUT'] == puts + 1
+    assert threads[0].startswith(thread)
+    assert not any(light['state']['on'] for light in sim.lights.values())
+
+
+def test_group_batcher_skips_hubs_without_groups(simulator, control):
+    address, sim = simulator(dimmable=1)
+    controller = control(address, group_batch_window=50)
+    node = [node for node in controller.nodes.values() if isinstance(node, hue.HueDimmLight)][0]
+    puts = sim.stats['PUT']
+    node.setBaseCtl({'cmd': 'DOF'})
+    ''' Sent right away, not after the batching window '''
+    assert sim.stats['PUT'] == puts + 1
+    assert len(controller.batcher.pending) == 0
+
+
+def closed_port():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    return port
+
+
+def test_request_records_refused_connection():
+    bridge = phue.Bridge('127.0.0.1:{}'.format(closed_port()), hue_sim.SIM_USER)
+    for _ in range(3):
+        with pytest.raises(ConnectionRefusedError):
+            bridge.request('GET', '/api/{}/lights'.format(hue_sim.SIM_USER))
+    assert bridge.metrics.requests == 3
+    assert bridge.metrics.error_rate() == 1.0
+
+
+def test_request_connect_timeout_is_request_timeout():
+    bridge = phue.Bridge('127.0.0.1:{}'.format(closed_port()), hue_sim.SIM_USER)
+
+    def timeout():
+        raise socket.timeout('timed out')
+    bridge.pool._connect = timeout
+    with pytest.raises(phue.PhueRequestTimeout):
+        bridge.request('GET', '/api/{}/lights'.format(hue_sim.SIM_USER))
+    assert bridge.metrics.error_rate() == 1.0
+
+
+def test_poll_keeps_drivers_of_queued_commands(simulator, control, reported_commands):
+    address, sim = simulator(dimmable=10)
+    for light in sim.lights.values():
+        light['state']['on'] = True
+    controller = control(address, async_commands=1, light_rate=2)
+    lights = [node for node in controller.nodes.values() if isinstance(node, hue.HueDimmLight)]
+    del reported_commands[:]
+    for node in lights:
+        node.setBaseCtl({'cmd': 'DOF'})
+    assert any(node.commandsPending() for node in lights)
+    controller.shortPoll()
+    assert [command for address, command in reported_commands if command == 'DON' or address != 'huegrp0'] == []
+    assert all(node.getDriver('ST') == 0 for node in lights)
+    wait_for(lambda: not any(node.queued for node in lights), 10)
+    controller.shortPoll()
+    assert [command for address, command in reported_commands if command == 'DON' or address != 'huegrp0'] == []
+    assert not any(light['state']['on'] for light in sim.lights.values())
+    assert all(node.getDriver('ST') == 0 for node in lights)
+
+
+def test_group_batcher_sends_rest_of_batch_after_failure(simulator, control):
+    address, sim = simulator(dimmable=4, groups=1)
+    controller = control(address, group_batch_window=50)
+    lights = sorted((node for node in controller.nodes.values() if isinstance(node, hue.HueDimmLight)),
+                    key=lambda node: node.element_id)
+    hub = controller.hub[address]
+    set_light = hub.set_light
+
+    def first_fails(light_id, command, *args, **kwargs):
+        if light_id == lights[0].element_id:
+            raise phue.PhueRequestTimeout(None, 'timed out')
+        return set_light(light_id, command, *args, **kwargs)
+    hub.set_light = first_fails
+    failed = []
+    lights[0]._commandFailed = failed.append
+    puts = sim.stats['PUT']
+    ''' No group has exactly these three lights, so each is sent on its own '''
+    for node in lights[:3]:
+        node.setBaseCtl({'cmd': 'DOF'})
+    wait_for(lambda: len(controller.batcher.pending) == 0 and not any(node.queued for node in lights))
+    assert failed == [{'on': False}]
+    assert sim.stats['PUT'] == puts + 2
+    assert not any(sim.lights[str(node.element_id)]['state']['on'] for node in lights[1:3])
+
+
+def test_scene_index_of_hubs_discovered_together(simulator, control, monkeypatch):
+    bridges = [simulator(dimmable=40, groups=20, scenes=20) for _ in range(3)]
+    info = hue.LOGGER.info
+
+    def slow_info(*args, **kwargs):
+        ''' Log file I/O gives other discovery threads a chance to run '''
+        time.sleep(0.0005)
+        info(*args, **kwargs)
+    monkeypatch.setattr(hue.LOGGER, 'info', slow_info)
+    controller = control([address for address, sim in bridges])
+    for address, sim in bridges:
+        assert len(controller.scene_index[address]) == 20 * 20
+    group = [node for node in controller.nodes.values() if isinstance(node, hue.HueGroup) and node.element_id == 20][-1]
+    assert group.setHueScene({'value': '19'})
+
+
+def test_event_stream_publishes_changed_copies(simulator, control):
+    address, sim = simulator(dimmable=2, groups=1)
+    for light in sim.lights.values():
+        light['state']['on'] = True
+    controller = control(address, event_stream='http')
+    wait_for(lambda: controller.event_streams[address].connected)
+    node = next(node for node in controller.nodes.values()
+                if isinstance(node, hue.HueDimmLight) and str(node.element_id) == '1')
+    lights = controller.lights[address]
+    groups = controller.groups[address]
+    with sim.lock:
+        ''' Changed outside of the node server, only the event stream tells about it '''
+        sim.set_state('1', {'on': False}, '/lights/1/state')
+    wait_for(lambda: node.getDriver('ST') == 0)
+    assert controller.lights[address]['1']['state']['on'] is False
+    assert controller.groups[address]['1']['state'] == {'all_on': False, 'any_on': True}
+    ''' The snapshot published before the event is left as it was '''
+    assert lights['1']['state']['on'] is True
+    assert groups['1']['state']['all_on'] is True
+    assert controller.event_streams[address].events == 1
+
+
+def run_frames(effect, count):
+    """ Commands of the effect's next frames, reported to its nodes as the engine does """
+    frames = []
+    for _ in range(count):
+        frame = effect.next_frame()
+        for resource, target_id, command in frame:
+            effect.report(resource, target_id, command)
+        frames.append(frame)
+    return frames
+
+
+def test_breathe_keeps_its_peak(simulator, control):
+    address, sim = simulator(dimmable=1)
+    sim.lights['1']['state'].update({'on': True, 'bri': 108})
+    controller = control(address)
+    node = next(node for node in controller.nodes.values() if isinstance(node, hue.HueDimmLight))
+    frames = run_frames(effects.Breathe(node), 6)
+    assert [frame[0][2]['bri'] for frame in frames] == [108, 21] * 3
+    assert node.brightness == 21
+
+
+def test_chase_sends_at_most_two_commands_per_frame(simulator, control):
+    address, sim = simulator(dimmable=3, groups=1)
+    controller = control(address)
+    group = next(node for node in controller.nodes.values()
+                 if isinstance(node, hue.HueGroup) and len(node.data.get('lights', [])) == 3)
+    effect = effects.Chase(group)
+    assert effect.cost() == (2, 0)
+    frames = run_frames(effect, 8)
+    ''' Lights are dimmed one by one, then the spot moves, dimming the light it leaves '''
+    assert [len(frame) for frame in frames] == [1, 1, 1, 1, 2, 2, 2, 2]
+    assert [command['bri'] for resource, target_id, command in frames[4]] == [254, 20]
+    assert frames[4][0][1] == frames[5][1][1]
+
+
+def test_sensor_poll_updates_battery_and_reachable(simulator, control, reported_commands):
+    address, sim = simulator(dimmable=1, dimmers=1, motion=1)
+    controller = control(address)
+    sensors = [node for node in controller.nodes.values() if isinstance(node, hue.HueSensor)]
+    assert len(sensors) == 4 and all(node.getDriver('GV6') == 1 for node in sensors)
+    del reported_commands[:]
+    with sim.lock:
+        ''' The bridge does not touch state.lastupdated for config changes '''
+        for sensor in sim.sensors.values():
+            sensor['config'].update({'reachable': False, 'battery': 40})
+    controller.shortPoll()
+    assert all(node.getDriver('GV6') == 0 and node.getDriver('BATLVL') == 40 for node in sensors)
+    assert reported_commands == []
+
+
+def test_poll_sets_only_changed_drivers(simulator, control, monkeypatch):
+    address, sim = simulator(dimmable=3, groups=1)
+    for light in sim.lights.values():
+        light['state'].update({'on': True, 'bri': 100})
+    controller = control(address)
+    node = next(node for node in controller.nodes.values()
+                if isinstance(node, hue.HueDimmLight) and str(node.element_id) == '1')
+    calls = []
+    set_driver = StubNode.setDriver
+
+    def record(self, driver, value, *args, **kwargs):
+        calls.append((self.address, driver))
+        return set_driver(self, driver, value, *args, **kwargs)
+    monkeypatch.setattr(StubNode, 'setDriver', record)
+    controller.shortPoll()
+    assert calls == []
+    with sim.lock:
+        sim.lights['1']['state']['bri'] = 200
+    controller.shortPoll()
+    assert sorted(calls) == [(node.address, 'GV5'), (node.address, 'ST')]
+    assert node.getDriver('GV5') == 200
+
+
+def test_hue_scene_index(simulator, control):
+    address, sim = simulator(dimmable=4, groups=2, scenes=3)
+    controller = control(address)
+    groups = {node.element_id: node for node in controller.nodes.values()
+              if isinstance(node, hue.HueGroup) and node.element_id in [1, 2]}
+    assert controller.scene_index[address] == {
+        (group_id, scene_idx): {'id': 'sim{:05d}{:04d}'.format(group_id, scene_idx), 'name': 'Sim Scene {}'.format(scene_idx)}
+        for group_id in [1, 2] for scene_idx in range(3)}
+    assert groups[2].setHueScene({'value': '1'})
+    wait_for(lambda: all(sim.lights[light_id]['state']['bri'] == state['bri']
+                         for light_id, state in sim.scene_states['sim000020001'].items()))
+    assert groups[2].setHueScene({'value': '3'}) is False
+
+
+def test_rediscovery_skips_unchanged_scenes(simulator, control, monkeypatch):
+    address, sim = simulator(dimmable=2, groups=1, scenes=2)
+    controller = control(address)
+    indexed = []
+    index_scenes = controller._indexScenes
+    monkeypatch.setattr(controller, '_indexScenes', lambda *args: indexed.append(args[0]) or index_scenes(*args))
+    nodes = dict(controller.nodes)
+    with sim.lock:
+        sim.lights['1']['name'] = 'Porch'
+    controller.discover()
+    wait_for(discovery_idle)
+    assert indexed == []
+    assert controller.nodes == nodes
+    assert [node.name for node in nodes.values() if getattr(node, 'element_id', None) == 1
+            and isinstance(node, hue.HueDimmLight)] == ['Porch']
+    with sim.lock:
+        sim.scenes['sim000010001'].update({'name': 'Evening', 'lastupdated': '2021-01-01T00:00:00'})
+    controller.discover()
+    wait_for(discovery_idle)
+    assert indexed == [address]
+    assert controller.scene_index[address][(1, 1)]['name'] == 'Evening'
+
+
+def test_fade_stop_reports_estimated_brightness(simulator, control):
+    address, sim = simulator(dimmable=1)
+    sim.lights['1']['state'].update({'on': True, 'bri': 100})
+    controller = control(address)
+    node = next(node for node in controller.nodes.values() if isinstance(node, hue.HueDimmLight))
+    node.setBaseCtl({'cmd': 'FDUP'})
+    assert node.fading()
+    ''' Drivers follow the fade instead of jumping to its end '''
+    assert node.getDriver('GV5') == 100
+    time.sleep(1)
+    node.setBaseCtl({'cmd': 'FDSTOP'})
+    assert 120 < node.getDriver('GV5') < 180
+    assert node.brightness == node.getDriver('GV5')
+    assert not node.fading()